@@ -0,0 +1,475 @@
+import asyncio
+import socket
+import time
+from packet import PacketCodec, PacketError, SYN, flag_names, is_legacy_json
+from reliable_udp import ReliableUDP, Stream, ESTABLISHED, CLOSED, TIME_WAIT
+from batch_io import HAVE_MMSG, BatchSender, BatchReceiver
+from timer_wheel import TimerWheel
+
+# Kernel receive buffer requested for server endpoints (capped by net.core.rmem_max),
+# so that a burst of handshakes from many clients is not dropped before the loop reads it
+SERVER_RCVBUF = 4 << 20
+
+
+class AsyncStream(Stream):
+    """A stream of an AsyncConnection; send() and receive() are coroutines."""
+
+    async def send(self, data):
+        if not self.connection.connected:
+            return False
+        self.queue_data(data)
+        return await self.connection.run_until(self.all_acked)
+
+    async def receive(self):
+        if await self.connection.run_until(self.readable, self.connection.max_idle_timeouts):
+            return self.pop_message()
+        return None
+
+
+class AsyncConnection(ReliableUDP):
+    """A ReliableUDP connection driven by an asyncio event loop.
+
+    The protocol core is the same; datagrams arrive through an AsyncEndpoint
+    and the retransmission timer sits on the endpoint's timer wheel instead
+    of being a socket timeout, so one thread can run any number of
+    connections. The blocking calls become coroutines of the same name.
+    """
+
+    stream_class = AsyncStream
+
+    def __init__(self, endpoint, **options):
+        super().__init__(*endpoint.local_addr, sock=endpoint.transport, checksum=endpoint.checksum, **options)
+        self.endpoint = endpoint
+        self.key = None
+        self.debug = endpoint.debug
+        self.loop = asyncio.get_running_loop()
+        self.on_established = None  # called once the handshake of an accepted connection completes
+        self._timer = None
+        self._waiters = []
+        self._lingering = False  # closed by the application, finishing TIME_WAIT in the background
+
+    def datagram_received(self, packet, addr):
+        # The endpoint has already decoded and verified the packet
+        self.debug_print("Packet received (seq=%s, flags=%s)", packet.seq, flag_names(packet.flags))
+        self.handle_packet(packet, addr)
+        self.update()
+
+    def send_datagram(self, header, payload):
+        self.endpoint.send(header, payload, self.remote_addr)
+
+    def on_timer(self):
+        self._timer = None
+        self.check_timers()
+        self.update()
+
+    def update(self):
+        """Send what the windows allow, re-arm the timer and wake any waiting coroutine."""
+        self.flush()
+        if self.on_established and (self.state == ESTABLISHED or self.failed):
+            callback, self.on_established = self.on_established, None
+            if self.failed:
+                self.debug_print("Connection acceptance failed")
+                self.close()
+            else:
+                callback(self)
+        if self._lingering and self.state == CLOSED:
+            self._lingering = False
+            self.close()
+        self.arm_timer()
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def arm_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        wait = self.next_timeout()
+        if wait is not None:
+            self._timer = self.endpoint.schedule(self.clock() + max(wait, 0), self.on_timer)
+
+    async def run_until(self, condition, idle_limit=None):
+        """Wait until condition() holds; the async counterpart of ReliableUDP.run_until."""
+        idle = 0
+        while True:
+            self.flush()
+            self.arm_timer()
+            if self.failed:
+                return False
+            if condition():
+                return True
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, None if self._timer else self.timeout)
+            except asyncio.TimeoutError:
+                idle += 1
+                self.debug_print("Timeout while waiting for packet")
+                if idle_limit is not None and idle >= idle_limit:
+                    return False
+            else:
+                idle = 0
+
+    async def send(self, data):
+        """Reliably send a message; returns once every segment has been acknowledged."""
+        if not self.remote_addr:
+            raise ValueError("Remote address not set")
+        if not self.connected:
+            return False
+        self.queue_data(data)
+        return await self.run_until(self.all_acked)
+
+    async def receive(self):
+        """Receive the next message as bytes, b"" once the peer has closed, None on timeout."""
+        if await self.run_until(self.readable, self.max_idle_timeouts):
+            return self.pop_message()
+        self.debug_print("Max receive attempts reached")
+        return None
+
+    async def accept_stream(self):
+        """Wait for the peer to open a stream; None on timeout or once it has closed."""
+        if await self.run_until(self.stream_acceptable, self.max_idle_timeouts) and self._accepted:
+            return self._accepted.popleft()
+        return None
+
+    async def establish_connection(self, remote_ip=None, remote_port=None):
+        self.start_connect(remote_ip, remote_port)
+        self.endpoint.register(self)
+        success = await self.run_until(lambda: self.state == ESTABLISHED)
+        if success:
+            self.debug_print("Connection established successfully")
+        else:
+            self.debug_print("Connection failed")
+        return success
+
+    async def close_connection(self):
+        """Close gracefully; unlike the blocking call, TIME_WAIT is left to run in the background."""
+        if not self.start_close():
+            return not self.failed
+        success = await self.run_until(lambda: self.state in (CLOSED, TIME_WAIT), self.max_idle_timeouts)
+        if success:
+            self.debug_print("Connection closed gracefully")
+        else:
+            self.debug_print("Connection close failed")
+        return success
+
+    def close(self):
+        """Stop the timer and forget the connection; the endpoint keeps its transport.
+
+        A connection in TIME_WAIT is only forgotten once TIME_WAIT ends, so it can
+        still re-ACK a retransmitted FIN.
+        """
+        if self.state == TIME_WAIT:
+            self._lingering = True
+            return
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self.endpoint.remove(self)
+        self.debug_print("Connection removed")
+
+
+class AsyncEndpoint(asyncio.DatagramProtocol):
+    """Datagram protocol that routes packets to AsyncConnections.
+
+    Packets are routed by (address, connection id), as listener.Listener
+    does. If on_connection is set, a SYN for an unknown key creates a new
+    connection, and on_connection(connection) is called once its handshake
+    completes. Extra keyword options apply to every connection.
+
+    Each wakeup drains every datagram already queued on the socket, and what
+    the connections send during a loop iteration goes out together at its end,
+    with sendmmsg/recvmmsg where available (see batch_io).
+
+    The connections' timers share one timer wheel, which a single loop
+    callback advances, so arming and cancelling them costs the same with
+    tens of thousands of connections as with one.
+
+    Datagrams that fail to decode are counted in checksum_failures, and in
+    the stats of the connection their conn_id field names, if any.
+    """
+
+    def __init__(self, checksum="crc32", on_connection=None, **options):
+        self.checksum = checksum
+        self.codec = PacketCodec(checksum)
+        self.on_connection = on_connection
+        self.options = options
+        self.debug = False
+        self.transport = None
+        self.local_addr = None
+        self.sender = None
+        self.receiver = None
+        self._outbox = []  # (header, payload, addr) to send at the end of this loop iteration
+        self.timers = TimerWheel(time.monotonic())
+        self._wakeup = None  # loop handle that next advances the wheel
+        self._wakeup_at = None
+        self.connections = {}  # (addr, conn_id) -> AsyncConnection
+        self.checksum_failures = 0
+        self.owns_transport = on_connection is None  # a client endpoint serves one connection
+
+    def set_debug_mode(self, debug):
+        self.debug = debug
+
+    def debug_print(self, message, *args):
+        if self.debug:
+            print("[DEBUG] " + (message % args if args else message))
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.local_addr = transport.get_extra_info("sockname")[:2]
+        sock = transport.get_extra_info("socket")
+        if self.on_connection is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SERVER_RCVBUF)
+        if HAVE_MMSG:
+            self.sender = BatchSender(sock)
+            self.receiver = BatchReceiver(sock)
+
+    def datagram_received(self, datagram, addr):
+        self.route(datagram, addr)
+        if self.receiver:
+            for datagram, addr in self.receiver.recv():
+                if self.transport.is_closing():
+                    break
+                self.route(datagram, addr)
+
+    def route(self, datagram, addr):
+        try:
+            packet = self.codec.decode(datagram)
+        except PacketError as e:
+            if is_legacy_json(datagram):
+                self.debug_print("Legacy JSON peer detected at %s, ignoring its packets", addr)
+                return
+            self.debug_print("Dropping undecodable datagram from %s: %s", addr, e)
+            self.checksum_failures += 1
+            connection = self.connections.get((addr, self.codec.peek_conn_id(datagram)))
+            if connection:
+                connection.checksum_failed(addr)
+            return
+        key = (addr, packet.conn_id)
+        connection = self.connections.get(key)
+        if connection is None:
+            if packet.flags != SYN or self.on_connection is None:
+                self.debug_print("Dropping packet for unknown connection %s", key)
+                return
+            connection = AsyncConnection(self, **self.options)
+            connection.start_listen()
+            connection.on_established = self.on_connection
+            connection.key = key
+            self.connections[key] = connection
+            self.debug_print("New connection %s", key)
+        connection.datagram_received(packet, addr)
+
+    def error_received(self, exc):
+        self.debug_print("Socket error: %s", exc)
+
+    def send(self, header, payload, addr):
+        if not self._outbox:
+            asyncio.get_running_loop().call_soon(self.send_outbox)
+        self._outbox.append((header, payload, addr))
+
+    def send_outbox(self):
+        outbox, self._outbox = self._outbox, []
+        if not outbox or self.transport.is_closing():
+            return
+        sent = 0
+        if self.sender and not self.transport.get_write_buffer_size():
+            # Nothing is queued in the transport, so writing to the socket directly keeps the order
+            sent = self.sender.send(outbox)
+        for header, payload, addr in outbox[sent:]:
+            self.transport.sendto(header + payload, addr)
+
+    def schedule(self, deadline, callback):
+        """Arm callback() on the timer wheel for deadline (time.monotonic() seconds)."""
+        timer = self.timers.schedule(deadline, callback)
+        if self._wakeup_at is None or timer.deadline < self._wakeup_at:
+            self.arm_wakeup(timer.deadline)
+        return timer
+
+    def arm_wakeup(self, when):
+        if self._wakeup:
+            self._wakeup.cancel()
+        self._wakeup_at = when
+        self._wakeup = None if when is None else asyncio.get_running_loop().call_at(when, self.run_timers)
+
+    def run_timers(self):
+        """Fire the due timers and sleep until the wheel next needs advancing."""
+        # The loop may run a callback marginally early; its deadline is what counts
+        now = max(time.monotonic(), self._wakeup_at)
+        self._wakeup = self._wakeup_at = None
+        self.timers.advance(now)
+        self.arm_wakeup(self.timers.next_expiry())
+
+    def register(self, connection):
+        connection.key = (connection.remote_addr, connection.conn_id)
+        self.connections[connection.key] = connection
+
+    def remove(self, connection):
+        if self.connections.get(connection.key) is connection:
+            del self.connections[connection.key]
+        if self.owns_transport and not self.connections:
+            self.close()
+
+    def close(self):
+        self.arm_wakeup(None)
+        self.send_outbox()
+        self.transport.close()
+
+
+class StreamReader:
+    """asyncio.StreamReader-compatible reading side of an AsyncConnection.
+
+    Messages are concatenated into a byte stream.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._buffer = bytearray()
+        self._eof = False
+
+    async def _fill(self):
+        message = await self.connection.receive()
+        if message:
+            self._buffer += message
+        else:
+            self._eof = True  # the peer closed, or went silent for too long
+
+    def at_eof(self):
+        return self._eof and not self._buffer
+
+    async def read(self, n=-1):
+        if n < 0:
+            while not self._eof:
+                await self._fill()
+        elif not self._buffer and not self._eof:
+            await self._fill()
+        if n < 0 or n >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:n])
+            del self._buffer[:n]
+        return data
+
+    async def readexactly(self, n):
+        while len(self._buffer) < n and not self._eof:
+            await self._fill()
+        if len(self._buffer) < n:
+            partial = bytes(self._buffer)
+            self._buffer.clear()
+            raise asyncio.IncompleteReadError(partial, n)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readuntil(self, separator=b"\n"):
+        start = 0
+        while True:
+            index = self._buffer.find(separator, start)
+            if index >= 0:
+                end = index + len(separator)
+                data = bytes(self._buffer[:end])
+                del self._buffer[:end]
+                return data
+            if self._eof:
+                partial = bytes(self._buffer)
+                self._buffer.clear()
+                raise asyncio.IncompleteReadError(partial, None)
+            # Only the new data (and a separator straddling the old end) needs searching
+            start = max(len(self._buffer) - len(separator) + 1, 0)
+            await self._fill()
+
+    async def readline(self):
+        try:
+            return await self.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+
+class StreamWriter:
+    """asyncio.StreamWriter-compatible writing side of an AsyncConnection.
+
+    Each write() is sent as one message; data may be an iterable of chunks,
+    read as the connection's windows open (see ReliableUDP.send).
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._closing = None
+
+    def get_extra_info(self, name, default=None):
+        info = {
+            "peername": self.connection.remote_addr,
+            "sockname": self.connection.local_addr,
+            "connection": self.connection,
+        }
+        return info.get(name, default)
+
+    def write(self, data):
+        if not self.connection.connected:
+            raise ConnectionResetError("Connection is closed")
+        self.connection.queue_data(data)
+        self.connection.update()
+
+    def writelines(self, data):
+        self.write(b"".join(data))
+
+    def can_write_eof(self):
+        return False
+
+    async def drain(self):
+        """Wait until everything written has been acknowledged."""
+        if not await self.connection.run_until(self.connection.all_acked):
+            raise ConnectionResetError("Connection failed")
+
+    def is_closing(self):
+        return self._closing is not None
+
+    def close(self):
+        if self._closing is None:
+            self._closing = asyncio.ensure_future(self._close())
+
+    async def _close(self):
+        try:
+            return await self.connection.close_connection()
+        finally:
+            self.connection.close()
+
+    async def wait_closed(self):
+        if self._closing is not None:
+            await self._closing
+
+
+async def open_connection(remote_ip, remote_port, local_ip="0.0.0.0", local_port=0, **options):
+    """Connect to a ReliableUDP server; returns a (StreamReader, StreamWriter) pair."""
+    loop = asyncio.get_running_loop()
+    _, endpoint = await loop.create_datagram_endpoint(lambda: AsyncEndpoint(**options),
+                                                      local_addr=(local_ip, local_port))
+    connection = AsyncConnection(endpoint, **endpoint.options)
+    if not await connection.establish_connection(remote_ip, remote_port):
+        connection.close()
+        endpoint.close()
+        raise ConnectionError(f"Could not connect to {(remote_ip, remote_port)}")
+    return StreamReader(connection), StreamWriter(connection)
+
+
+async def start_server(client_connected_cb, local_ip, local_port, **options):
+    """Serve ReliableUDP connections on one port, like asyncio.start_server.
+
+    client_connected_cb(reader, writer) is called, or scheduled if it is a
+    coroutine function, for every connection that completes its handshake.
+    Returns the AsyncEndpoint; close() it to stop serving.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    def on_connection(connection):
+        result = client_connected_cb(StreamReader(connection), StreamWriter(connection))
+        if asyncio.iscoroutine(result):
+            task = loop.create_task(result)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    _, endpoint = await loop.create_datagram_endpoint(lambda: AsyncEndpoint(on_connection=on_connection, **options),
+                                                      local_addr=(local_ip, local_port))
+    return endpoint
@@ -0,0 +1,210 @@
+import ctypes
+import errno
+import select
+import socket
+import struct
+import sys
+import threading
+
+# Datagrams moved per system call
+BATCH_SIZE = 32
+
+# Initial size of each receive slot: a default-MSS segment plus its header.
+# Slots grow the first time a larger datagram arrives.
+SLOT_SIZE = 2048
+
+# Largest UDP payload, the slot size when truncation cannot be detected
+MAX_DATAGRAM = 65535
+
+MSG_TRUNC = getattr(socket, "MSG_TRUNC", 0)
+
+SOCKADDR_IN = struct.Struct("=H2s4s8x")  # family (host order), port and address (network order)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def load_libc():
+    """libc with sendmmsg/recvmmsg (Linux), or None to fall back to one call per datagram."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = load_libc()
+HAVE_MMSG = _libc is not None
+
+
+def would_block(err):
+    return err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+
+class MessageVector:
+    """Preallocated slots of one contiguous buffer, each described by an mmsghdr."""
+
+    def __init__(self, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = bytearray(slots * slot_size)
+        self.view = memoryview(self.buffer)
+        self.names = bytearray(slots * SOCKADDR_IN.size)
+        self.iovecs = (iovec * slots)()
+        self.msgs = (mmsghdr * slots)()
+        base = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+        names = ctypes.addressof(ctypes.c_char.from_buffer(self.names))
+        for i in range(slots):
+            self.iovecs[i].iov_base = base + i * slot_size
+            self.iovecs[i].iov_len = slot_size
+            header = self.msgs[i].msg_hdr
+            header.msg_name = names + i * SOCKADDR_IN.size
+            header.msg_namelen = SOCKADDR_IN.size
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+
+    def slot(self, i, length=None):
+        start = i * self.slot_size
+        return self.view[start:start + (self.slot_size if length is None else length)]
+
+
+class BatchSender:
+    """Sends many (header, payload, addr) datagrams per sendmmsg call.
+
+    Each datagram is copied into a preallocated slot. send() returns how many
+    datagrams went out; it stops early when the socket buffer is full or a
+    datagram cannot be batched (too large for a slot, or addressed by host
+    name), leaving the rest to the caller's one-at-a-time path. Without
+    sendmmsg it sends nothing. Connections sharing a socket may share its sender.
+    """
+
+    def __init__(self, sock, slots=BATCH_SIZE, slot_size=SLOT_SIZE):
+        self.socket = sock
+        self.use_mmsg = HAVE_MMSG and sock.family == socket.AF_INET
+        self.vector = MessageVector(slots, slot_size) if self.use_mmsg else None
+        self._names = {}  # addr -> packed sockaddr_in
+        self.lock = threading.Lock()
+
+    def sockaddr(self, addr):
+        name = self._names.get(addr)
+        if name is None:
+            try:
+                host = socket.inet_aton(addr[0])
+            except OSError:
+                return None
+            name = SOCKADDR_IN.pack(socket.AF_INET, addr[1].to_bytes(2, "big"), host)
+            self._names[addr] = name
+        return name
+
+    def send(self, datagrams):
+        if not self.use_mmsg:
+            return 0
+        sent = 0
+        with self.lock:
+            while sent < len(datagrams):
+                count = self.send_vector(datagrams, sent)
+                if count <= 0:
+                    break
+                sent += count
+        return sent
+
+    def send_vector(self, datagrams, first):
+        """sendmmsg the batchable run starting at first; how many were sent."""
+        vector = self.vector
+        count = 0
+        for header, payload, addr in datagrams[first:first + vector.slots]:
+            length = len(header) + len(payload)
+            name = self.sockaddr(addr)
+            if length > vector.slot_size or name is None:
+                break
+            slot = vector.slot(count, length)
+            slot[:len(header)] = header
+            slot[len(header):] = payload
+            vector.names[count * SOCKADDR_IN.size:(count + 1) * SOCKADDR_IN.size] = name
+            vector.iovecs[count].iov_len = length
+            count += 1
+        if count == 0:
+            return 0
+        result = _libc.sendmmsg(self.socket.fileno(), vector.msgs, count, 0)
+        if result < 0:
+            err = ctypes.get_errno()
+            if would_block(err):
+                return 0
+            raise OSError(err, f"sendmmsg: {errno.errorcode.get(err, err)}")
+        return result
+
+
+class BatchReceiver:
+    """Drains every datagram already queued on a socket, without blocking.
+
+    recv() returns a list of up to slots (datagram, addr), where each
+    datagram is a memoryview of a preallocated slot, valid until the next
+    recv(). Without recvmmsg the socket is polled and read once per datagram.
+    """
+
+    def __init__(self, sock, slots=BATCH_SIZE, slot_size=SLOT_SIZE):
+        self.socket = sock
+        self.slots = slots
+        self.use_mmsg = HAVE_MMSG and sock.family == socket.AF_INET
+        self.vector = MessageVector(slots, slot_size) if self.use_mmsg else None
+        self._buffers = []  # full-size slots for the fallback, allocated as bursts need them
+
+    def recv(self):
+        if self.use_mmsg:
+            return self.recv_vector()
+        datagrams = []
+        for i in range(self.slots):
+            # A socket with a timeout waits before reading even with MSG_DONTWAIT, so poll it first
+            if not select.select([self.socket], [], [], 0)[0]:
+                break
+            if i == len(self._buffers):
+                self._buffers.append(bytearray(MAX_DATAGRAM))
+            size, addr = self.socket.recvfrom_into(self._buffers[i])
+            datagrams.append((memoryview(self._buffers[i])[:size], addr))
+        return datagrams
+
+    def recv_vector(self):
+        vector = self.vector
+        count = _libc.recvmmsg(self.socket.fileno(), vector.msgs, vector.slots, socket.MSG_DONTWAIT | MSG_TRUNC, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if would_block(err) or err == errno.EINTR:
+                return []
+            raise OSError(err, f"recvmmsg: {errno.errorcode.get(err, err)}")
+        datagrams = []
+        largest = 0
+        for i in range(count):
+            msg = vector.msgs[i]
+            size = msg.msg_len
+            if msg.msg_hdr.msg_flags & MSG_TRUNC:
+                largest = max(largest, size)  # lost; the sender will retransmit it
+            else:
+                family, port, host = SOCKADDR_IN.unpack_from(vector.names, i * SOCKADDR_IN.size)
+                datagrams.append((vector.slot(i, size), (socket.inet_ntoa(host), int.from_bytes(port, "big"))))
+            msg.msg_hdr.msg_namelen = SOCKADDR_IN.size
+            msg.msg_hdr.msg_flags = 0
+        if largest:
+            # Earlier slots stay valid: the datagrams above keep the old buffer alive
+            self.vector = MessageVector(vector.slots, largest)
+        return datagrams
@@ -0,0 +1,175 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import subprocess
+import threading
+import time
+from reliable_udp import ReliableUDP, ESTABLISHED
+from simnet import SimNetwork
+
+# Simulated links give up after this much virtual time
+SIM_TIME_LIMIT = 600.0
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def run_sim(case, messages, seed):
+    """Send messages over a SimNetwork; returns (ok, elapsed, latencies, sender stats) in virtual time."""
+    net = SimNetwork(seed=seed, loss=case["loss"], corruption=case["corruption"], delay=case["rtt"] / 2,
+                     bandwidth=case["bandwidth"], queue_limit=case["queue_limit"])
+    options = dict(window_size=case["window"], congestion=case["congestion"], mss=case["mss"], pacing=case["pacing"],
+                   rate_limit=case["rate_limit"])
+    sender = net.endpoint("10.0.0.1", 1, **options)
+    receiver = net.endpoint("10.0.0.2", 2, **options)
+    receiver.start_listen()
+    sender.start_connect(*receiver.local_addr)
+    if not net.run_until(lambda: sender.state == ESTABLISHED, SIM_TIME_LIMIT):
+        return False, 0.0, [], sender.stats()
+    latencies = []
+    start = net.now
+    for msg in messages:
+        queued = net.now
+        sender.queue_message(msg)
+        if not net.run_until(receiver.readable, SIM_TIME_LIMIT) or receiver.pop_message() != msg:
+            return False, net.now - start, latencies, sender.stats()
+        latencies.append(net.now - queued)
+        net.run_until(sender.all_acked, SIM_TIME_LIMIT)
+    return True, net.now - start, latencies, sender.stats()
+
+
+def run_loopback(case, messages, port):
+    """Send messages between two sockets on 127.0.0.1; returns (ok, elapsed, latencies, sender stats)."""
+    options = dict(window_size=case["window"], congestion=case["congestion"], mss=case["mss"], pacing=case["pacing"],
+                   rate_limit=case["rate_limit"])
+    receiver = ReliableUDP("127.0.0.1", port, **options)
+    sender = ReliableUDP("127.0.0.1", port + 1, "127.0.0.1", port, **options)
+    for connection in (sender, receiver):
+        connection.configure_error_simulation(case["loss"], case["corruption"])
+    received_at = []
+
+    def receive():
+        if receiver.accept_connection():
+            for msg in messages:
+                if receiver.receive() != msg:
+                    break
+                received_at.append(time.perf_counter())
+            receiver.close_connection()
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    ok = sender.establish_connection()
+    queued_at = []
+    start = time.perf_counter()
+    if ok:
+        for msg in messages:
+            queued_at.append(time.perf_counter())
+            if not sender.send(msg):
+                ok = False
+                break
+    thread.join()
+    elapsed = (received_at[-1] if received_at else time.perf_counter()) - start
+    stats = sender.stats()
+    if ok:
+        sender.close_connection()
+    sender.close()
+    receiver.close()
+    latencies = [done - queued for queued, done in zip(queued_at, received_at)]
+    return ok and len(received_at) == len(messages), elapsed, latencies, stats
+
+
+def run_case(case, count, seed, port):
+    messages = [bytes([i % 256]) * case["size"] for i in range(count)]
+    cpu = time.process_time()
+    if case["link"] == "sim":
+        ok, elapsed, latencies, stats = run_sim(case, messages, seed)
+    else:
+        ok, elapsed, latencies, stats = run_loopback(case, messages, port)
+    cpu = time.process_time() - cpu
+    megabytes = case["size"] * count / 1e6
+    segments = count * max(math.ceil(case["size"] / case["mss"]), 1)
+    return dict(case, messages=count, ok=ok, elapsed=elapsed,
+                goodput_mbps=megabytes * 8 / elapsed if ok and elapsed > 0 else 0.0,
+                latency_p50=percentile(latencies, 0.5), latency_p99=percentile(latencies, 0.99),
+                retransmission_ratio=stats["retransmissions"] / segments,
+                timeouts=stats["timeouts"], fast_retransmits=stats["fast_retransmits"],
+                cpu_per_mb=cpu / megabytes if megabytes else None)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_list(kind):
+    return lambda text: [kind(item) for item in text.split(",")]
+
+
+def positive_int(text):
+    """argparse type for counts and sizes: an empty transfer has no goodput or CPU per MB to report."""
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure ReliableUDP goodput, latency and overhead.")
+    parser.add_argument("--link", type=parse_list(str), default=["sim"], help="sim and/or loopback")
+    parser.add_argument("--size", type=parse_list(positive_int), default=[1000, 100000], help="message sizes in bytes")
+    parser.add_argument("--loss", type=parse_list(float), default=[0.0, 0.05])
+    parser.add_argument("--corruption", type=parse_list(float), default=[0.0])
+    parser.add_argument("--rtt", type=parse_list(float), default=[0.02], help="seconds, simulated link only")
+    parser.add_argument("--window", type=parse_list(int), default=[64])
+    parser.add_argument("--congestion", type=parse_list(str), default=["reno"])
+    parser.add_argument("--pacing", type=parse_list(lambda text: text == "on"), default=[True], help="on and/or off")
+    parser.add_argument("--rate-limit", type=float, default=None, help="payload bytes/s per connection")
+    parser.add_argument("--mss", type=int, default=1400)
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes/s, simulated link only")
+    parser.add_argument("--queue-limit", type=int, default=None, help="bytes, simulated link only")
+    parser.add_argument("--messages", type=positive_int, default=20, help="messages per case")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=17000, help="first loopback port")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    results = []
+    port = args.port
+    for link, size, loss, corruption, rtt, window, congestion, pacing in itertools.product(
+            args.link, args.size, args.loss, args.corruption, args.rtt, args.window, args.congestion, args.pacing):
+        if link == "loopback" and rtt != args.rtt[0]:
+            continue  # loopback RTT cannot be set
+        case = dict(link=link, size=size, loss=loss, corruption=corruption,
+                    rtt=rtt if link == "sim" else None, window=window, congestion=congestion, mss=args.mss,
+                    pacing=pacing, rate_limit=args.rate_limit, bandwidth=args.bandwidth, queue_limit=args.queue_limit)
+        result = run_case(case, args.messages, args.seed, port)
+        port += 2
+        results.append(result)
+        print(f"{link:8} size={size:<7} loss={loss:<5} corrupt={corruption:<5} rtt={rtt if link == 'sim' else '-':<5} "
+              f"window={window:<4} {congestion:6} {'paced' if pacing else 'bursty':6} ok={result['ok']!s:5} goodput={result['goodput_mbps']:8.2f} Mbit/s "
+              f"p50={result['latency_p50'] or 0:.4f}s p99={result['latency_p99'] or 0:.4f}s "
+              f"retx={result['retransmission_ratio']:.3f} cpu/MB={result['cpu_per_mb']:.3f}s")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
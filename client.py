@@ -1,61 +1,270 @@
 from reliable_udp import ReliableUDP
+from async_reliable_udp import open_connection
+from collections import defaultdict
 import datetime
+import threading
+import time
 
-def build_http_request(method, path, host, body=''):
+# Idle pooled connections are closed after this many seconds, before the
+# server gives up on them (ReliableUDP.max_idle_timeouts receive timeouts)
+POOL_IDLE_TIMEOUT = 15.0
+
+def build_http_request(method, path, host, body='', keep_alive=False):
     current_date = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
 
     headers = [
-        f'{method} {path} HTTP/1.0',
+        f'{method} {path} HTTP/1.1',
         f'Host: {host}',
         f'Date: {current_date}',
         'User-Agent: CustomUDPClient/1.0',
         'Accept: */*',
-        'Connection: close'
+        'Connection: keep-alive' if keep_alive else 'Connection: close'
     ]
 
     if method == 'POST':
         headers.append('Content-Type: text/plain; charset=utf-8')
-        headers.append(f'Content-Length: {len(body)}')
+        headers.append(f'Content-Length: {len(body.encode())}')
 
     headers.append('')  # empty line before body
     headers.append(body)
 
     return '\r\n'.join(headers)
 
+def parse_response_head(head):
+    """Status code and headers (names lower-cased) of a response head."""
+    lines = head.decode(errors='replace').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+def split_response(pending):
+    """Split the first complete response off pending bytes, framed by its Content-Length.
+
+    Returns (response, headers, rest), or None until the whole response has arrived.
+    """
+    end = pending.find(b'\r\n\r\n')
+    if end < 0:
+        return None
+    _, headers = parse_response_head(pending[:end])
+    stop = end + 4 + int(headers.get('content-length', 0))
+    if len(pending) < stop:
+        return None
+    return pending[:stop], headers, pending[stop:]
+
+class HTTPConnection:
+    """HTTP/1.1 requests over one persistent ReliableUDP connection.
+
+    Requests ask for keep-alive and responses are framed by Content-Length,
+    so any number of them share one handshake. pipeline() sends several
+    requests before reading the first response; the server answers them in order.
+    """
+
+    def __init__(self, connection, host='localhost'):
+        self.connection = connection
+        self.host = host
+        self.keep_alive = True  # False once the server has said it will close
+        self._pending = b''
+
+    def request(self, method, path, body=''):
+        """Send one request and return the raw response, None if none arrived."""
+        return self.pipeline([(method, path, body)])[0]
+
+    def pipeline(self, requests):
+        """Send (method, path, body) requests back to back and return their responses in order.
+
+        A response is None if the connection failed or was closed before it arrived.
+        """
+        if not self.keep_alive or not self.connection.connected:
+            return [None] * len(requests)
+        for method, path, body in requests:
+            self.connection.queue_data(build_http_request(method, path, self.host, body, keep_alive=True))
+        # Reading the first response sends the queued requests
+        return [self.read_response() for _ in requests]
+
+    def read_response(self):
+        while True:
+            split = split_response(self._pending)
+            if split:
+                response, headers, self._pending = split
+                if headers.get('connection', '').lower() == 'close':
+                    self.keep_alive = False
+                return response
+            data = self.connection.receive()
+            if not data:
+                self.keep_alive = False
+                return None
+            self._pending += data
+
+    def healthy(self):
+        """Handle whatever arrived while idle without waiting; False if the server closed or failed."""
+        connection = self.connection
+        for datagram, addr in connection.recv_ready():
+            connection.handle_datagram(datagram, addr)
+        connection.flush()
+        return self.keep_alive and connection.connected and not connection.fin_received and not self._pending
+
+    def close(self):
+        self.connection.close_connection()
+        self.connection.close()
+
+class ClientSession:
+    """Reuses established connections across requests.
+
+    Up to max_per_host connections are kept per server address, each bound
+    to an ephemeral local port. request() takes an idle one, or opens a new
+    one when none is free, and returns it to the pool afterwards; past the
+    limit it waits for one. A pooled connection is checked on reuse and
+    closed once idle for idle_timeout seconds. Extra keyword options are
+    passed to ReliableUDP.
+    """
+
+    def __init__(self, addr=('127.0.0.1', 8080), max_per_host=4, idle_timeout=POOL_IDLE_TIMEOUT, local_ip='127.0.0.1',
+                 host='localhost', **options):
+        if max_per_host < 1:
+            raise ValueError("At least one connection per host is needed")
+        self.addr = addr
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.local_ip = local_ip
+        self.host = host
+        self.options = options
+        self._idle = defaultdict(list)  # addr -> [(HTTPConnection, idle since)], most recently used last
+        self._open = defaultdict(int)  # addr -> connections open, idle or in use
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def request(self, method, path, body='', addr=None):
+        """Send one request and return the raw response, None if it failed.
+
+        A GET that fails on a reused connection (the server may have just
+        closed it) is retried once on a new one.
+        """
+        addr = addr or self.addr
+        for _ in range(2):
+            http, reused = self.checkout(addr)
+            if http is None:
+                return None
+            response = http.request(method, path, body)
+            self.checkin(addr, http)
+            if response is not None or not reused or method != 'GET':
+                return response
+        return None
+
+    def checkout(self, addr):
+        """An established connection to addr and whether it was pooled; (None, False) if connecting fails."""
+        http = None
+        reserved = False
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise ValueError("Session is closed")
+                stale = self.expire(addr)
+                idle = self._idle[addr]
+                while idle and http is None:
+                    candidate, _ = idle.pop()
+                    if candidate.healthy():
+                        http = candidate
+                    else:
+                        self._open[addr] -= 1
+                        stale.append(candidate)
+                if http is None and self._open[addr] < self.max_per_host:
+                    self._open[addr] += 1
+                    reserved = True
+                if http or reserved:
+                    break
+                self.condition.wait()
+        # Closing waits for the server, so it happens outside the lock
+        self.close_all(stale)
+        if http:
+            return http, True
+        connection = ReliableUDP(self.local_ip, 0, *addr, **self.options)
+        if connection.establish_connection():
+            return HTTPConnection(connection, self.host), False
+        connection.close()
+        with self.condition:
+            self._open[addr] -= 1
+            self.condition.notify()
+        return None, False
+
+    def expire(self, addr):
+        """Take idle connections to addr past idle_timeout out of the pool, to be closed."""
+        idle = self._idle[addr]
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = [http for http, since in idle if since <= cutoff]
+        idle[:] = [(http, since) for http, since in idle if since > cutoff]
+        self._open[addr] -= len(expired)
+        return expired
+
+    def checkin(self, addr, http):
+        """Return a connection to the pool, or close it if the server is done with it."""
+        with self.condition:
+            if not self.closed and http.healthy():
+                self._idle[addr].append((http, time.monotonic()))
+                http = None
+            else:
+                self._open[addr] -= 1
+            self.condition.notify()
+        if http:
+            http.close()
+
+    def close_all(self, connections):
+        for http in connections:
+            http.close()
+
+    def close(self):
+        """Close every idle connection; ones in use are closed when returned."""
+        with self.condition:
+            self.closed = True
+            stale = [http for idle in self._idle.values() for http, _ in idle]
+            for addr, idle in self._idle.items():
+                self._open[addr] -= len(idle)
+            self._idle.clear()
+            self.condition.notify_all()
+        self.close_all(stale)
+
+async def request_async(method, path, body='', host='127.0.0.1', port=8080):
+    """Send one request over an asyncio connection and return the raw response."""
+    reader, writer = await open_connection(host, port)
+    writer.write(build_http_request(method, path, 'localhost', body).encode())
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    _, headers = parse_response_head(head)
+    response = head + await reader.readexactly(int(headers.get('content-length', 0)))
+    writer.close()
+    await writer.wait_closed()
+    return response
+
 def main():
-    client = ReliableUDP('127.0.0.1', 9090, '127.0.0.1', 8080)
-    client.set_debug_mode(True)
-
-    if not client.establish_connection():
-        print("Failed to connect to server.")
-        return
-
-    print("Connection established.")
-    method = input("Enter method (GET or POST): ").strip().upper()
-
-    if method not in ['GET', 'POST']:
-        print("Unsupported method.")
-        client.close_connection()
-        client.close()
-        return
-
-    if method == 'GET':
-        path = input("Enter path: ").strip()
-        request = build_http_request('GET', path, 'localhost')
-    else:
-        path = '/'
-        body = input("Enter data to POST: ")
-        request = build_http_request('POST', path, 'localhost', body)
-
-    client.send(request)
-    response = client.receive()
-
-    if response:
-        print("\nResponse from server:\n")
-        print(response)
-
-    client.close_connection()
-    client.close()
+    # Requests share pooled connections from ephemeral local ports
+    session = ClientSession(('127.0.0.1', 8080))
+
+    while True:
+        method = input("Enter method (GET or POST, blank to quit): ").strip().upper()
+        if not method:
+            break
+
+        if method not in ['GET', 'POST']:
+            print("Unsupported method.")
+            continue
+
+        if method == 'GET':
+            path = input("Enter path: ").strip()
+            response = session.request('GET', path)
+        else:
+            body = input("Enter data to POST: ")
+            response = session.request('POST', '/', body)
+
+        if response:
+            print("\nResponse from server:\n")
+            print(response.decode(errors='replace'))
+        else:
+            print("Failed to get a response from the server.")
+
+    session.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,261 @@
+import math
+from collections import deque
+
+# Windows are counted in segments, matching the sequence number space
+INITIAL_CWND = 10  # RFC 6928
+MIN_CWND = 2
+
+
+class CongestionController:
+    """Interface shared by the congestion control algorithms.
+
+    The connection reports every acknowledgement, loss and RTT sample; each
+    callback returns the new (cwnd, pacing_rate). cwnd is in segments and
+    pacing_rate in segments per second (None until an RTT has been measured).
+    """
+
+    name = None
+
+    def __init__(self, initial_cwnd=INITIAL_CWND):
+        self.cwnd = float(initial_cwnd)
+        self.ssthresh = math.inf
+        self.srtt = None
+        self.min_rtt = None
+        self.pacing_rate = None
+
+    def in_slow_start(self):
+        return self.cwnd < self.ssthresh
+
+    def on_ack(self, acked, in_flight, now, limited=False):
+        """acked segments were newly acknowledged; in_flight are still outstanding.
+
+        limited is true if the sender last ran out of data or was held back by
+        a rate limit, so the delivery rate says little about the network.
+        """
+        return self.cwnd, self.pacing_rate
+
+    def on_loss(self, in_flight, now, timeout=False):
+        """A loss was detected, by duplicate ACKs or by a retransmission timeout."""
+        return self.cwnd, self.pacing_rate
+
+    def on_rtt(self, rtt, now):
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.update_pacing_rate()
+        return self.cwnd, self.pacing_rate
+
+    def update_pacing_rate(self):
+        """Spread cwnd over an RTT, a little faster to leave room for growth (as Linux does)."""
+        if self.srtt:
+            gain = 2.0 if self.in_slow_start() else 1.2
+            self.pacing_rate = gain * self.cwnd / self.srtt
+
+
+class Reno(CongestionController):
+    """Slow start and AIMD congestion avoidance (RFC 5681).
+
+    NewReno recovery (RFC 6582) comes from the connection, which reports at
+    most one loss per recovery episode and retransmits on partial ACKs.
+    """
+
+    name = "reno"
+
+    def on_ack(self, acked, in_flight, now, limited=False):
+        if self.in_slow_start():
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.update_pacing_rate()
+        return self.cwnd, self.pacing_rate
+
+    def on_loss(self, in_flight, now, timeout=False):
+        self.ssthresh = max(in_flight / 2, MIN_CWND)
+        self.cwnd = 1.0 if timeout else self.ssthresh
+        self.update_pacing_rate()
+        return self.cwnd, self.pacing_rate
+
+
+class Cubic(CongestionController):
+    """CUBIC window growth (RFC 8312), with its Reno-friendly region."""
+
+    name = "cubic"
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, initial_cwnd=INITIAL_CWND):
+        super().__init__(initial_cwnd)
+        self.w_max = 0.0
+        self.epoch_start = None
+        self.origin = 0.0  # window the cubic curve plateaus at
+        self.k = 0.0  # seconds from the start of the epoch to the plateau
+        self.w_est = 0.0  # what Reno would have reached, for the friendly region
+
+    def on_ack(self, acked, in_flight, now, limited=False):
+        if self.in_slow_start():
+            self.cwnd += acked
+        else:
+            if self.epoch_start is None:
+                self.epoch_start = now
+                if self.cwnd < self.w_max:
+                    self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+                    self.origin = self.w_max
+                else:
+                    self.k = 0.0
+                    self.origin = self.cwnd
+                self.w_est = self.cwnd
+            t = now - self.epoch_start + (self.srtt or 0.0)
+            target = min(self.origin + self.C * (t - self.k) ** 3, 1.5 * self.cwnd)
+            if target > self.cwnd:
+                self.cwnd += (target - self.cwnd) / self.cwnd * acked
+            else:
+                self.cwnd += 0.01 * acked / self.cwnd
+            self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * acked / self.cwnd
+            self.cwnd = max(self.cwnd, self.w_est)
+        self.update_pacing_rate()
+        return self.cwnd, self.pacing_rate
+
+    def on_loss(self, in_flight, now, timeout=False):
+        self.epoch_start = None
+        # Fast convergence: release bandwidth if the last plateau was not reached
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * self.BETA, MIN_CWND)
+        self.cwnd = 1.0 if timeout else self.ssthresh
+        self.update_pacing_rate()
+        return self.cwnd, self.pacing_rate
+
+
+class BBRLite(CongestionController):
+    """A simplified BBR: paces at the measured bottleneck bandwidth.
+
+    Bandwidth is the windowed maximum of per-round delivery rates, and the
+    window is a multiple of the bandwidth-delay product. It has the STARTUP,
+    DRAIN and PROBE_BW phases but no PROBE_RTT; the minimum RTT is instead
+    refreshed from the latest sample once it is MIN_RTT_WINDOW old. Random
+    loss does not shrink the window, only a retransmission timeout does; that
+    also discards the bandwidth estimate and goes back to STARTUP. Rounds the
+    sender could not fill only count if they beat the estimate.
+    """
+
+    name = "bbr"
+    STARTUP = "STARTUP"
+    DRAIN = "DRAIN"
+    PROBE_BW = "PROBE_BW"
+    STARTUP_GAIN = 2 / math.log(2)
+    PROBE_BW_GAINS = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+    CWND_GAIN = 2
+    BW_WINDOW_ROUNDS = 10
+    MIN_RTT_WINDOW = 10.0
+    MIN_CWND = 4
+
+    def __init__(self, initial_cwnd=INITIAL_CWND):
+        super().__init__(initial_cwnd)
+        self.mode = self.STARTUP
+        self.btl_bw = None  # segments per second
+        self.bw_samples = deque(maxlen=self.BW_WINDOW_ROUNDS)
+        self.min_rtt_stamp = None
+        self.delivered = 0
+        self.round_start = None
+        self.round_delivered = 0
+        self.round_limited = False
+        self.full_bw = 0.0
+        self.full_bw_rounds = 0
+        self.cycle_index = 0
+
+    def pacing_gain(self):
+        if self.mode == self.STARTUP:
+            return self.STARTUP_GAIN
+        if self.mode == self.DRAIN:
+            return 1 / self.STARTUP_GAIN
+        return self.PROBE_BW_GAINS[self.cycle_index]
+
+    def bdp(self):
+        if self.btl_bw is None or self.min_rtt is None:
+            return None
+        return self.btl_bw * self.min_rtt
+
+    def on_rtt(self, rtt, now):
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        if self.min_rtt is None or rtt <= self.min_rtt or now - self.min_rtt_stamp > self.MIN_RTT_WINDOW:
+            self.min_rtt = rtt
+            self.min_rtt_stamp = now
+        self.update_pacing_rate()
+        return self.cwnd, self.pacing_rate
+
+    def on_ack(self, acked, in_flight, now, limited=False):
+        self.delivered += acked
+        if self.round_start is None:
+            self.round_start = now
+            self.round_delivered = self.delivered - acked
+            self.round_limited = False
+        self.round_limited = self.round_limited or limited
+        elapsed = now - self.round_start
+        if self.min_rtt and elapsed >= self.min_rtt:
+            # One round trip has passed: take a delivery rate sample
+            rate = (self.delivered - self.round_delivered) / elapsed
+            if not self.round_limited or self.btl_bw is None or rate > self.btl_bw:
+                self.bw_samples.append(rate)
+                self.btl_bw = max(self.bw_samples)
+            self.round_start = now
+            self.round_delivered = self.delivered
+            self.on_round(self.round_limited)
+            self.round_limited = False
+
+        bdp = self.bdp()
+        if self.mode == self.DRAIN and bdp is not None and in_flight <= bdp:
+            self.mode = self.PROBE_BW
+            self.cycle_index = 0
+        target = None if bdp is None else self.CWND_GAIN * bdp
+        if self.mode == self.STARTUP and target is not None:
+            target *= self.STARTUP_GAIN / self.CWND_GAIN
+        if target is None or self.cwnd < target:
+            self.cwnd += acked
+        if target is not None and self.mode != self.STARTUP:
+            self.cwnd = min(self.cwnd, target)
+        self.cwnd = max(self.cwnd, self.MIN_CWND)
+        self.update_pacing_rate()
+        return self.cwnd, self.pacing_rate
+
+    def on_round(self, limited):
+        if self.mode == self.STARTUP:
+            # The pipe is full once bandwidth stops growing by 25% for three full rounds
+            if self.btl_bw >= 1.25 * self.full_bw:
+                self.full_bw = self.btl_bw
+                self.full_bw_rounds = 0
+            elif not limited:
+                self.full_bw_rounds += 1
+                if self.full_bw_rounds >= 3:
+                    self.mode = self.DRAIN
+        elif self.mode == self.PROBE_BW:
+            self.cycle_index = (self.cycle_index + 1) % len(self.PROBE_BW_GAINS)
+
+    def on_loss(self, in_flight, now, timeout=False):
+        if timeout:
+            self.cwnd = float(self.MIN_CWND)
+            # The stalled round would read as a bandwidth collapse: measure afresh
+            self.mode = self.STARTUP
+            self.btl_bw = None
+            self.bw_samples.clear()
+            self.full_bw = 0.0
+            self.full_bw_rounds = 0
+            self.round_start = None
+            self.update_pacing_rate()
+        return self.cwnd, self.pacing_rate
+
+    def update_pacing_rate(self):
+        if self.btl_bw:
+            self.pacing_rate = self.pacing_gain() * self.btl_bw
+        elif self.srtt:
+            self.pacing_rate = self.STARTUP_GAIN * self.cwnd / self.srtt
+
+
+# name -> controller class, selectable per connection
+CONGESTION_CONTROLLERS = {cls.name: cls for cls in (Reno, Cubic, BBRLite)}
+
+
+def make_controller(name, initial_cwnd=INITIAL_CWND):
+    if name not in CONGESTION_CONTROLLERS:
+        raise ValueError(f"Unknown congestion controller {name!r}, expected one of {sorted(CONGESTION_CONTROLLERS)}")
+    return CONGESTION_CONTROLLERS[name](initial_cwnd)
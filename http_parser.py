@@ -0,0 +1,100 @@
+from collections import namedtuple
+
+# Largest request line plus headers, and most header fields, a request may have
+MAX_HEADER_BYTES = 16 << 10
+MAX_HEADERS = 100
+
+# Events returned by RequestParser.next_event(), besides Request and body chunks (bytes)
+NEED_DATA = "NEED_DATA"
+END_OF_REQUEST = "END_OF_REQUEST"
+
+# headers maps lower-cased field names to values
+Request = namedtuple("Request", ["method", "path", "version", "headers"])
+
+
+class HTTPParseError(ValueError):
+    """Raised for a request that cannot be parsed; status is the HTTP error code to answer with."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RequestParser:
+    """Incremental HTTP/1.x request parser.
+
+    feed() bytes as they arrive, in pieces of any size, then call
+    next_event() until it returns NEED_DATA. Each request produces a
+    Request, its body as one or more bytes chunks (framed by Content-Length)
+    and END_OF_REQUEST; pipelined requests follow one another.
+
+    The end of the headers is searched for only in newly fed bytes, and body
+    chunks are handed out as they arrive, so a large body is never buffered
+    whole.
+    """
+
+    def __init__(self, max_header_bytes=MAX_HEADER_BYTES, max_headers=MAX_HEADERS):
+        self.max_header_bytes = max_header_bytes
+        self.max_headers = max_headers
+        self._buffer = bytearray()
+        self._scanned = 0  # bytes of the buffer already known not to end the headers
+        self._body_left = None  # body bytes still to come, None while reading headers
+
+    def feed(self, data):
+        self._buffer += data
+
+    def next_event(self):
+        if self._body_left is None:
+            return self.parse_head()
+        if self._body_left == 0:
+            self._body_left = None
+            return END_OF_REQUEST
+        if not self._buffer:
+            return NEED_DATA
+        if len(self._buffer) <= self._body_left:
+            chunk, self._buffer = bytes(self._buffer), bytearray()
+        else:
+            chunk = bytes(self._buffer[:self._body_left])
+            del self._buffer[:self._body_left]
+        self._body_left -= len(chunk)
+        return chunk
+
+    def parse_head(self):
+        buffer = self._buffer
+        # Skip the blank lines allowed before a request line
+        while buffer[:2] == b"\r\n":
+            del buffer[:2]
+        # The terminator may straddle the previous feed, so back up three bytes
+        end = buffer.find(b"\r\n\r\n", max(self._scanned - 3, 0))
+        if end < 0:
+            if len(buffer) > self.max_header_bytes:
+                raise HTTPParseError(431, "request headers too large")
+            self._scanned = len(buffer)
+            return NEED_DATA
+        if end > self.max_header_bytes:
+            raise HTTPParseError(431, "request headers too large")
+        lines = buffer[:end].decode("latin-1").split("\r\n")
+        del buffer[:end + 4]
+        self._scanned = 0
+
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise HTTPParseError(400, f"malformed request line {lines[0]!r}")
+        if len(lines) - 1 > self.max_headers:
+            raise HTTPParseError(431, f"more than {self.max_headers} header fields")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            name = name.strip().lower()
+            if not sep or not name:
+                raise HTTPParseError(400, f"malformed header line {line!r}")
+            value = value.strip()
+            headers[name] = f"{headers[name]}, {value}" if name in headers else value
+
+        if "transfer-encoding" in headers:
+            raise HTTPParseError(501, "Transfer-Encoding is not supported")
+        length = headers.get("content-length", "0")
+        if not (length.isascii() and length.isdigit()):  # isdigit() alone accepts "²"
+            raise HTTPParseError(400, f"invalid Content-Length {length!r}")
+        self._body_left = int(length)
+        return Request(parts[0], parts[1], parts[2], headers)
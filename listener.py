@@ -0,0 +1,208 @@
+import queue
+import socket
+import threading
+from packet import PacketCodec, PacketError, SYN, flag_names, is_legacy_json
+from reliable_udp import ReliableUDP, RECV_BUFFER_SIZE
+from batch_io import BATCH_SIZE, BatchSender, BatchReceiver
+
+# Datagrams a connection may have waiting before further ones are dropped,
+# like a full socket receive buffer
+CONNECTION_QUEUE_SIZE = 1024
+
+# How often the routing thread checks whether the listener was closed
+POLL_INTERVAL = 0.5
+
+# Queued in a connection's inbox in place of a packet that failed to decode
+UNDECODABLE = "UNDECODABLE"
+
+
+class ListenerConnection(ReliableUDP):
+    """A connection accepted by a Listener.
+
+    It sends through the listener's socket and receives the packets the
+    listener has already decoded and routed to it.
+    """
+
+    def __init__(self, listener, key, **options):
+        super().__init__(*listener.local_addr, sock=listener.socket, checksum=listener.checksum, **options)
+        self.listener = listener
+        self.key = key
+        self.debug = listener.debug
+        self.sender = listener.sender
+        self._inbox = queue.Queue(CONNECTION_QUEUE_SIZE)
+
+    def recv_datagram(self, timeout):
+        """Wait up to timeout seconds for a routed packet; (None, None) on timeout."""
+        if timeout <= 0:
+            return None, None
+        try:
+            return self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+
+    def recv_ready(self):
+        packets = []
+        while len(packets) < BATCH_SIZE:
+            try:
+                packets.append(self._inbox.get_nowait())
+            except queue.Empty:
+                break
+        return packets
+
+    def handle_datagram(self, packet, addr):
+        # The listener has already decoded and verified the packet
+        if packet is UNDECODABLE:
+            self.checksum_failed(addr)
+            return
+        self.debug_print("Packet received (seq=%s, flags=%s)", packet.seq, flag_names(packet.flags))
+        self.handle_packet(packet, addr)
+
+    def close(self):
+        """Forget the connection; the shared socket stays open."""
+        self.listener.remove(self.key)
+        self.debug_print("Connection removed")
+
+
+class Listener:
+    """Serves many ReliableUDP connections from one bound port.
+
+    A background thread reads the socket, decodes each datagram and routes it
+    by (address, connection id) to its connection. A SYN for an unknown key
+    creates a new connection, which accept() hands out once the handshake
+    completes. Each connection is then driven by whichever thread uses it.
+    Extra keyword options (timeout, mss, mode, ...) apply to every connection.
+    Datagrams that fail to decode are counted in checksum_failures, and in
+    the stats of the connection their conn_id field names, if any.
+    sock is an already bound socket to serve instead of binding a new one
+    (see prefork.PreforkServer).
+    """
+
+    def __init__(self, local_ip, local_port, checksum="crc32", backlog=128, sock=None, **options):
+        self.local_addr = (local_ip, local_port)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(self.local_addr)
+        self.socket = sock
+        self.local_addr = sock.getsockname()
+        self.socket.settimeout(POLL_INTERVAL)
+        self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
+        self.receiver = BatchReceiver(self.socket)
+        self.sender = BatchSender(self.socket)  # shared by the connections
+        self.debug = False
+        self.checksum = checksum
+        self.codec = PacketCodec(checksum)
+        self.options = options
+        ListenerConnection(self, None, **options)  # validate the options up front
+        self.connections = {}  # (addr, conn_id) -> ListenerConnection
+        self.lock = threading.Lock()
+        self._pending = queue.Queue(backlog)  # new connections waiting for accept()
+        self.accepting = True
+        self.closed = False
+        self.checksum_failures = 0
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+
+    def set_debug_mode(self, debug):
+        self.debug = debug
+
+    def debug_print(self, message, *args):
+        if self.debug:
+            print("[DEBUG] " + (message % args if args else message))
+
+    def serve(self):
+        """Read datagrams and route them until the listener is closed."""
+        while not self.closed:
+            try:
+                size, addr = self.socket.recvfrom_into(self._recv_buffer)
+                # Whatever queued up meanwhile is drained in the same wakeup
+                datagrams = [(self._recv_view[:size], addr)] + self.receiver.recv()
+            except socket.timeout:
+                continue
+            except OSError:
+                break  # socket closed
+            for datagram, addr in datagrams:
+                self.route(datagram, addr)
+
+    def route(self, datagram, addr):
+        """Decode a datagram and queue it for its connection.
+
+        The datagram is a view of the reused receive buffer, so only the payload
+        of a packet that is actually queued gets copied.
+        """
+        try:
+            packet = self.codec.decode(datagram)
+        except PacketError as e:
+            if is_legacy_json(datagram):
+                self.debug_print("Legacy JSON peer detected at %s, ignoring its packets", addr)
+                return
+            self.debug_print("Dropping undecodable datagram from %s: %s", addr, e)
+            self.checksum_failures += 1
+            with self.lock:
+                connection = self.connections.get((addr, self.codec.peek_conn_id(datagram)))
+            if connection:
+                # Counted on the connection's own thread, like its other counters
+                try:
+                    connection._inbox.put_nowait((UNDECODABLE, addr))
+                except queue.Full:
+                    pass
+            return
+        key = (addr, packet.conn_id)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is None:
+                if packet.flags != SYN:
+                    self.debug_print("Dropping packet for unknown connection %s", key)
+                    return
+                if not self.accepting:
+                    self.debug_print("Not accepting, dropping SYN from %s", addr)
+                    return
+                connection = ListenerConnection(self, key, **self.options)
+                try:
+                    self._pending.put_nowait(connection)
+                except queue.Full:
+                    self.debug_print("Backlog full, dropping SYN from %s", addr)
+                    return
+                self.connections[key] = connection
+                self.debug_print("New connection %s", key)
+        try:
+            connection._inbox.put_nowait((packet._replace(data=bytes(packet.data)), addr))
+        except queue.Full:
+            self.debug_print("Connection %s is not keeping up, dropping packet", key)
+
+    def accept(self, timeout=None):
+        """Return the next connection whose handshake succeeds, None on timeout.
+
+        The SYN that created the connection is already in its inbox, so its
+        accept_connection() answers right away.
+        """
+        while True:
+            try:
+                connection = self._pending.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if connection.accept_connection():
+                return connection
+            connection.close()
+
+    def stop_accepting(self):
+        """Drop new SYNs and the backlog; established connections carry on."""
+        with self.lock:
+            self.accepting = False
+            while True:
+                try:
+                    connection = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                self.connections.pop(connection.key, None)
+
+    def remove(self, key):
+        with self.lock:
+            self.connections.pop(key, None)
+
+    def close(self):
+        """Stop routing and close the shared socket."""
+        self.closed = True
+        self._thread.join()
+        self.socket.close()
+        self.debug_print("Listener closed")
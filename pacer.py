@@ -0,0 +1,56 @@
+import math
+
+# The pacer lets this much go out back to back: at least PACING_BURST_SEGMENTS
+# segments, or PACING_QUANTUM seconds' worth of data at high rates, since
+# timers cannot wake the sender for every segment (Linux's fq works the same way)
+PACING_BURST_SEGMENTS = 2
+PACING_QUANTUM = 0.001
+
+
+class TokenBucket:
+    """Token bucket rate limiter, in bytes.
+
+    Tokens accrue at rate bytes per second, up to burst. Sending consumes
+    them, and may take the bucket into debt (a segment larger than what is
+    left, or a retransmission that cannot wait): the next send then waits
+    until the debt is repaid. A rate of None lets everything through.
+    """
+
+    def __init__(self, rate=None, burst=0, now=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def configure(self, rate, burst, now):
+        """Change the rate, crediting the time since the last update at the old one."""
+        self.refill(now)
+        if self.rate is None:
+            self.tokens = burst  # start full, as a new bucket does
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def refill(self, now):
+        if self.rate is not None and now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = max(self.updated, now)
+
+    def wait_time(self, amount, now):
+        """Seconds until amount bytes may be sent (0 if they may go now)."""
+        if self.rate is None:
+            return 0.0
+        self.refill(now)
+        # Less than a byte short is close enough, and rounding might never make it up
+        needed = min(amount, self.burst) - self.tokens
+        return needed / self.rate if needed >= 1 else 0.0
+
+    def consume(self, amount, now):
+        if self.rate is not None:
+            self.refill(now)
+            self.tokens -= amount
+
+
+def pacing_burst(rate, mss):
+    """Bucket depth for pacing at rate bytes per second with MSS-sized segments."""
+    return max(PACING_BURST_SEGMENTS * mss, math.ceil(rate * PACING_QUANTUM))
@@ -0,0 +1,168 @@
+import hashlib
+import struct
+import zlib
+from collections import namedtuple
+
+# Wire format version. Legacy peers send JSON objects, whose first byte is '{'.
+VERSION = 1
+
+# Flag bits
+SYN = 0x01
+ACK = 0x02
+FIN = 0x04
+DAT = 0x08
+EOM = 0x10  # last segment of a message
+STM = 0x20  # the payload starts with a stream header
+
+FLAG_NAMES = ((SYN, "SYN"), (FIN, "FIN"), (DAT, "DAT"), (EOM, "EOM"), (STM, "STM"), (ACK, "ACK"))
+
+# Largest payload the u16 length field can describe
+MAX_PAYLOAD = 0xFFFF
+
+# Largest receive window (in segments) the u16 window field can advertise
+MAX_WINDOW = 0xFFFF
+
+# Selective acknowledgement blocks carried as the payload of a pure ACK:
+# [start, end) ranges of sequence numbers received out of order
+SACK_BLOCK = struct.Struct("!II")
+MAX_SACK_BLOCKS = 4
+
+# Header extension of a data segment flagged STM: the stream it belongs to and
+# its position within that stream (see reliable_udp.Stream)
+STREAM_HEADER = struct.Struct("!HI")
+MAX_STREAM_ID = 0xFFFF
+
+Packet = namedtuple("Packet", ["flags", "conn_id", "seq", "ack", "window", "data"])
+
+
+class PacketError(ValueError):
+    """Raised when a datagram cannot be decoded into a packet."""
+
+
+def format_flags(flags):
+    return "".join(name for bit, name in FLAG_NAMES if flags & bit) or "NONE"
+
+
+# Every combination of the six flag bits, precomputed since flags are named per packet
+_FLAG_STRINGS = [format_flags(flags) for flags in range(0x40)]
+
+
+def flag_names(flags):
+    """Readable form of a flags bitfield, e.g. SYNACK or FINACK."""
+    return _FLAG_STRINGS[flags] if flags < 0x40 else format_flags(flags)
+
+
+def encode_sack(blocks):
+    return b"".join(SACK_BLOCK.pack(start, end) for start, end in blocks[:MAX_SACK_BLOCKS])
+
+
+def decode_sack(data):
+    usable = len(data) - len(data) % SACK_BLOCK.size
+    return [SACK_BLOCK.unpack_from(data, offset) for offset in range(0, usable, SACK_BLOCK.size)]
+
+
+def is_legacy_json(datagram):
+    """True if the datagram looks like a packet from a JSON-encoding peer."""
+    return datagram[:1] == b"{"
+
+
+def crc32_checksum(header, data):
+    """CRC-32 over header and payload (default)."""
+    return zlib.crc32(data, zlib.crc32(header)).to_bytes(4, "big")
+
+
+def internet_checksum(header, data):
+    """16-bit one's complement sum (RFC 1071).
+
+    Since 2**16 == 1 (mod 0xFFFF), the sum of the 16-bit words is the value of the
+    whole buffer taken mod 0xFFFF, which avoids a Python-level loop over words.
+    The header has an even length, so it can be summed separately.
+    """
+    if len(data) % 2:
+        data = bytes(data) + b"\x00"
+    total = (int.from_bytes(header, "big") + int.from_bytes(data, "big")) % 0xFFFF
+    return (~total & 0xFFFF).to_bytes(2, "big")
+
+
+def md5_checksum(header, data):
+    """Full MD5 digest, for when a cryptographic hash is wanted."""
+    digest = hashlib.md5(header)
+    digest.update(data)
+    return digest.digest()
+
+
+# name -> (function, digest size in bytes). Both peers must use the same one.
+CHECKSUMS = {
+    "crc32": (crc32_checksum, 4),
+    "internet": (internet_checksum, 2),
+    "md5": (md5_checksum, 16),
+}
+
+
+class PacketCodec:
+    """Encodes and decodes the fixed-size binary packet header.
+
+    Layout (network byte order):
+        version:u8 flags:u8 conn_id:u32 seq:u32 ack:u32 window:u16 length:u16 checksum:digest_size
+    conn_id is chosen by the connecting side and lets a listener tell apart
+    connections from the same address. window is the sender's free receive buffer, in segments past ack. The checksum covers the header fields and the payload. Its width depends on
+    the algorithm picked from CHECKSUMS (4 bytes for the default CRC-32).
+
+    A data segment flagged STM starts its payload with a STREAM_HEADER
+    (stream_id:u16 stream_seq:u32). encode_header() takes it separately as
+    the extension, so the payload itself is never copied to prepend it.
+    """
+
+    HEADER = struct.Struct("!BBIIIHH")
+    CHECKSUM_OFFSET = HEADER.size
+
+    def __init__(self, checksum="crc32"):
+        if checksum not in CHECKSUMS:
+            raise ValueError(f"Unknown checksum {checksum!r}, expected one of {sorted(CHECKSUMS)}")
+        self.checksum, self.digest_size = CHECKSUMS[checksum]
+        self.header_size = self.HEADER.size + self.digest_size
+
+    def encode(self, flags, conn_id, seq, ack, window, data=b"", extension=b""):
+        return b"".join((self.encode_header(flags, conn_id, seq, ack, window, data, extension), data))
+
+    def encode_header(self, flags, conn_id, seq, ack, window, data=b"", extension=b""):
+        """Header and checksum for data, to be sent followed by data (scatter-gather).
+
+        An extension (of even length) goes after the checksum and counts as the
+        start of the payload.
+        """
+        header = self.HEADER.pack(VERSION, flags, conn_id, seq, ack, window, len(extension) + len(data))
+        return header + self.checksum(header + extension, data) + extension
+
+    def peek_conn_id(self, datagram):
+        """The conn_id field of a datagram that failed to decode, None if it is too short to have one.
+
+        The field may be corrupted itself, so it only serves to attribute the failure.
+        """
+        if len(datagram) < self.HEADER.size:
+            return None
+        return self.HEADER.unpack_from(datagram)[2]
+
+    def decode(self, datagram):
+        """Parse a datagram; the returned payload is a memoryview into it.
+
+        The datagram may itself be a memoryview of a reused receive buffer, in
+        which case the payload must be copied before the buffer is refilled.
+        """
+        if len(datagram) < self.header_size:
+            if is_legacy_json(datagram):
+                raise PacketError("legacy JSON packet")
+            raise PacketError(f"short packet ({len(datagram)} bytes)")
+        version, flags, conn_id, seq, ack, window, length = self.HEADER.unpack_from(datagram)
+        if version != VERSION:
+            if is_legacy_json(datagram):
+                raise PacketError("legacy JSON packet")
+            raise PacketError(f"unsupported version {version}")
+        view = memoryview(datagram)
+        data = view[self.header_size:]
+        if len(data) != length:
+            raise PacketError(f"length mismatch: header says {length}, got {len(data)}")
+        checksum = view[self.CHECKSUM_OFFSET:self.header_size]
+        if self.checksum(view[:self.CHECKSUM_OFFSET], data) != checksum:
+            raise PacketError("checksum mismatch")
+        return Packet(flags, conn_id, seq, ack, window, data)
@@ -0,0 +1,186 @@
+import ctypes
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+from listener import Listener, POLL_INTERVAL
+
+# Seconds a stopping worker waits for its connections to finish before exiting
+DRAIN_TIMEOUT = 10.0
+
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, "SO_ATTACH_REUSEPORT_CBPF", 51)
+
+# Classic BPF instructions (code, jt, jf, k)
+SOCK_FILTER = struct.Struct("HBBI")
+BPF_LD_W_ABS = 0x20
+BPF_ALU_MOD_K = 0x94
+BPF_RET_A = 0x16
+
+# Offset of the u32 conn_id in a packet (see packet.PacketCodec)
+CONN_ID_OFFSET = 2
+
+
+def conn_id_program(workers):
+    """cBPF program choosing the socket conn_id % workers of a reuseport group.
+
+    For UDP the program sees the datagram payload, i.e. our packet header.
+    """
+    return b"".join(SOCK_FILTER.pack(*instruction) for instruction in (
+        (BPF_LD_W_ABS, 0, 0, CONN_ID_OFFSET),
+        (BPF_ALU_MOD_K, 0, 0, workers),
+        (BPF_RET_A, 0, 0, 0),
+    ))
+
+
+def steer_by_conn_id(sock, workers):
+    """Route each datagram of the group sock belongs to by its conn_id; False if unsupported.
+
+    Without it the kernel hashes the address 4-tuple, which also keeps a
+    connection on one socket as long as the group's sockets stay open.
+    """
+    program = ctypes.create_string_buffer(conn_id_program(workers))
+    fprog = struct.pack("@HP", len(program.raw) // SOCK_FILTER.size, ctypes.addressof(program))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+    except OSError:
+        return False
+    return True
+
+
+def reuseport_sockets(local_ip, local_port, count):
+    """count UDP sockets bound to the same address with SO_REUSEPORT, in group order."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("SO_REUSEPORT is not supported on this platform")
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((local_ip, local_port))
+        sockets.append(sock)
+    return sockets
+
+
+def run_worker(sock, handler, debug, drain_timeout, options):
+    """Accept connections on sock and serve each with handler(connection) in a thread, until SIGTERM.
+
+    A stopping worker drops new SYNs and lets its connections finish, for up
+    to drain_timeout seconds.
+    """
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops the workers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    listener = Listener(*sock.getsockname(), sock=sock, **options)
+    listener.set_debug_mode(debug)
+    while not stopping.is_set():
+        connection = listener.accept(timeout=POLL_INTERVAL)
+        if connection:
+            listener.debug_print("Worker %s accepted %s", os.getpid(), connection.remote_addr)
+            threading.Thread(target=handler, args=(connection,), daemon=True).start()
+    listener.stop_accepting()
+    deadline = time.monotonic() + drain_timeout
+    while listener.connections and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+    listener.close()
+
+
+class PreforkServer:
+    """Serves one UDP port from several worker processes, each with its own Listener.
+
+    The parent binds one SO_REUSEPORT socket per worker and keeps them all
+    open, so the kernel's reuseport group never changes. Where possible a
+    cBPF program steers every datagram to socket conn_id % workers; otherwise
+    the kernel hashes the address 4-tuple. Either way a connection stays with
+    the worker that accepted it.
+
+    A worker that dies is replaced on the same socket. restart() replaces
+    the workers one at a time: each stops taking new connections and lets its
+    own finish first. SYNs reaching its socket meanwhile are dropped and
+    retransmitted by the clients until the replacement is up.
+    """
+
+    def __init__(self, handler, local_ip, local_port, workers=None, drain_timeout=DRAIN_TIMEOUT, **options):
+        self.handler = handler
+        self.local_addr = (local_ip, local_port)
+        self.workers = workers or os.cpu_count() or 1
+        if self.workers < 1:
+            raise ValueError("At least one worker is needed")
+        self.drain_timeout = drain_timeout
+        self.options = options
+        self.debug = False
+        self.context = multiprocessing.get_context("fork")
+        self.sockets = []
+        self.processes = []
+        self.steered = False
+        self._restart_requested = False
+        self.stopped = False
+
+    def set_debug_mode(self, debug):
+        self.debug = debug
+
+    def debug_print(self, message, *args):
+        if self.debug:
+            print("[DEBUG] " + (message % args if args else message))
+
+    def start(self):
+        self.sockets = reuseport_sockets(*self.local_addr, self.workers)
+        self.steered = steer_by_conn_id(self.sockets[0], self.workers)
+        self.debug_print("Steering by %s", "connection id" if self.steered else "address hash")
+        self.processes = [self.spawn(index) for index in range(self.workers)]
+
+    def spawn(self, index):
+        process = self.context.Process(target=run_worker, daemon=True, args=(
+            self.sockets[index], self.handler, self.debug, self.drain_timeout, self.options))
+        process.start()
+        self.debug_print("Worker %s started with pid %s", index, process.pid)
+        return process
+
+    def restart(self):
+        """Gracefully replace every worker, one at a time."""
+        for index, process in enumerate(self.processes):
+            if self.stopped:
+                return
+            process.terminate()
+            process.join()
+            self.processes[index] = self.spawn(index)
+
+    def supervise(self, timeout=None):
+        """Replace workers that exited, for up to timeout seconds (forever if None)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.stopped:
+            if self._restart_requested:
+                self._restart_requested = False
+                self.restart()
+            wait = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, deadline - time.monotonic())
+            if wait <= 0:
+                return
+            multiprocessing.connection.wait([process.sentinel for process in self.processes], wait)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self.stopped:
+                    self.debug_print("Worker %s (pid %s) exited with %s", index, process.pid, process.exitcode)
+                    self.processes[index] = self.spawn(index)
+
+    def serve_forever(self):
+        """Start the workers and supervise them; SIGHUP restarts them, Ctrl-C stops everything."""
+        self.start()
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, "_restart_requested", True))
+        try:
+            self.supervise()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop the workers, letting them drain, and close the sockets."""
+        self.stopped = True
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        for sock in self.sockets:
+            sock.close()
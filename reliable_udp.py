@@ -1,21 +1,207 @@
 import socket
-import json
-import hashlib
 import random
 import time
+from collections import OrderedDict, deque
+from packet import (PacketCodec, PacketError, SYN, ACK, FIN, DAT, EOM, STM, MAX_PAYLOAD, MAX_SACK_BLOCKS, MAX_WINDOW,
+                    MAX_STREAM_ID, STREAM_HEADER, flag_names, is_legacy_json, encode_sack, decode_sack)
+from rtt import RTTEstimator
+from congestion import make_controller
+from pacer import TokenBucket, pacing_burst
+from batch_io import BatchSender, BatchReceiver
+
+# Large enough for any datagram, whatever MSS the peer uses
+RECV_BUFFER_SIZE = 65535
+
+# sendmsg() sends a header and a payload as one datagram without joining them first
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# Sequence numbers are 32-bit and wrap around
+SEQ_MASK = 0xFFFFFFFF
+
+# Transmission modes
+STOP_AND_WAIT = "stop-and-wait"
+GO_BACK_N = "gbn"
+SELECTIVE_REPEAT = "sr"
+MODES = (STOP_AND_WAIT, GO_BACK_N, SELECTIVE_REPEAT)
+
+# Connection states
+CLOSED = "CLOSED"
+LISTEN = "LISTEN"
+SYN_SENT = "SYN_SENT"
+SYN_RCVD = "SYN_RCVD"
+ESTABLISHED = "ESTABLISHED"
+FIN_WAIT = "FIN_WAIT"
+LAST_ACK = "LAST_ACK"  # peer closed first, waiting for our FINACK to be acknowledged
+TIME_WAIT = "TIME_WAIT"  # both FINs acknowledged, lingering to re-ACK a retransmitted FIN
+
+# TIME_WAIT lasts this many retransmission timeouts: enough for the peer to
+# back off and resend its FIN twice (1 + 2 + 4 RTOs)
+TIME_WAIT_RTOS = 8
+
+# Duplicate ACKs that trigger a fast retransmit
+DUP_ACK_THRESHOLD = 3
+
+# Per-connection counters, reported by stats()
+COUNTERS = ("packets_sent", "bytes_sent", "packets_received", "bytes_received", "retransmissions", "timeouts",
+            "fast_retransmits", "checksum_failures", "duplicates", "rtt_samples")
+
+
+def seq_add(seq, n):
+    return (seq + n) & SEQ_MASK
+
+
+def seq_diff(a, b):
+    """Distance from b forward to a, modulo 2**32."""
+    return (a - b) & SEQ_MASK
+
+
+def seq_lt(a, b):
+    """True if a comes before b in sequence space (RFC 1982 serial arithmetic)."""
+    return a != b and seq_diff(b, a) < 0x80000000
+
+
+class Segment:
+    """An unacknowledged segment held in the send buffer.
+
+    header is the encoded header last sent for it, and header_ack the
+    (ack, window) it carries; a retransmission reuses it while those still hold.
+    extension is the stream header of an STM segment. attempts counts the
+    retransmissions held against max_retransmissions: not those of a
+    Go-Back-N window resent behind an earlier segment.
+    """
+
+    __slots__ = ("seq", "flags", "data", "extension", "stream_id", "first_sent_at", "sent_at", "retransmits", "attempts",
+                 "header", "header_ack")
+
+    def __init__(self, seq, flags, data, extension=b"", stream_id=0):
+        self.seq = seq
+        self.flags = flags
+        self.data = data
+        self.extension = extension
+        self.stream_id = stream_id
+        self.first_sent_at = None
+        self.sent_at = 0.0
+        self.retransmits = 0
+        self.attempts = 0
+        self.header = None
+        self.header_ack = None
+
+
+class Stream:
+    """One of a connection's independently ordered message channels (see ReliableUDP.open_stream).
+
+    The streams of a connection share its sequence numbers, windows and
+    retransmissions, but each reassembles its own messages in order, so a
+    segment lost on one stream holds back no other. Stream 0 is the
+    connection's own send() and receive().
+    """
+
+    def __init__(self, connection, stream_id, send_queue=None):
+        self.connection = connection
+        self.id = stream_id
+        self.send_queue = deque() if send_queue is None else send_queue
+        self.scheduled = False  # in the connection's round-robin
+        self.send_seq = 0  # stream_seq of the next segment sent
+        self.recv_seq = 0  # stream_seq of the next segment to reassemble
+        self.out_of_order = {}  # stream_seq -> (flags, data) that arrived ahead of recv_seq
+        self.reassembly = bytearray()  # the message being reassembled
+        self.messages = deque()  # complete messages ready for receive()
+
+    def queue_data(self, data):
+        self.connection.queue_data(data, self.id)
+
+    def send(self, data):
+        """Reliably send a message on this stream; blocks until it has been acknowledged."""
+        if not self.connection.connected:
+            return False
+        self.queue_data(data)
+        return self.connection.run_until(self.all_acked)
+
+    def all_acked(self):
+        return not self.send_queue and not any(s.stream_id == self.id for s in self.connection._unacked.values())
+
+    def receive(self):
+        """Next message on this stream, b"" once the peer has closed, None on timeout."""
+        if self.connection.run_until(self.readable, self.connection.max_idle_timeouts):
+            return self.pop_message()
+        return None
+
+    def readable(self):
+        connection = self.connection
+        return self.messages or connection.fin_received or connection.state == CLOSED
+
+    def pop_message(self):
+        """Next complete message, or b"" if there is none (the peer has closed)."""
+        if not self.messages:
+            return b""
+        message = self.messages.popleft()
+        connection = self.connection
+        connection._buffered -= len(message)
+        connection._waiting_messages -= 1
+        if connection.advertised_window == 0 and connection.receive_window() > 0 and connection.connected:
+            connection.send_ack()  # window update, so the peer need not wait for its next probe
+        return message
+
+    def on_segment(self, stream_seq, flags, data):
+        """Reassemble a segment now in the connection's receive window, buffering it if it came early."""
+        if stream_seq != self.recv_seq:
+            if seq_lt(self.recv_seq, stream_seq):
+                self.out_of_order[stream_seq] = (flags, bytes(data))
+            return
+        self.deliver(flags, data)
+        self.recv_seq = seq_add(self.recv_seq, 1)
+        while self.recv_seq in self.out_of_order:
+            self.deliver(*self.out_of_order.pop(self.recv_seq))
+            self.recv_seq = seq_add(self.recv_seq, 1)
+
+    def deliver(self, flags, data):
+        """Copy an in-order payload out of the receive buffer into its message."""
+        connection = self.connection
+        connection._buffered += len(data)
+        if flags & EOM and not self.reassembly:
+            message = bytes(data)  # a single-segment message is copied just once
+        else:
+            self.reassembly += data
+            if not flags & EOM:
+                return
+            message, self.reassembly = bytes(self.reassembly), bytearray()
+        self.messages.append(message)
+        connection._waiting_messages += 1
+
 
 class ReliableUDP:
-    def __init__(self, local_ip, local_port, remote_ip=None, remote_port=None, timeout=2):
+    # Class of the objects open_stream() and accept_stream() return
+    stream_class = Stream
+
+    def __init__(self, local_ip, local_port, remote_ip=None, remote_port=None, timeout=2, checksum="crc32",
+                 mss=1400, mode=SELECTIVE_REPEAT, window_size=16, min_rto=0.01, max_rto=8.0, congestion="reno",
+                 receive_buffer=1 << 20, delayed_ack_segments=2, delayed_ack_timeout=0.025, pacing=True, rate_limit=None,
+                 sock=None):
         self.local_addr = (local_ip, local_port)
         self.remote_addr = (remote_ip, remote_port) if remote_ip and remote_port else None
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(self.local_addr)
-        self.socket.settimeout(timeout)
-        self.seq = 0
-        self.ack = 0
+        if sock is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind(self.local_addr)
+            self.local_addr = self.socket.getsockname()  # the port the OS picked, if local_port was 0
+            self.socket.settimeout(timeout)
+            # Datagrams are read into one preallocated buffer; decoded payloads are views
+            # into it, so whatever must outlive the next read is copied out (see deliver)
+            self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+            self._recv_view = memoryview(self._recv_buffer)
+            self.sender = BatchSender(self.socket)
+            self.receiver = BatchReceiver(self.socket)
+        else:
+            # A bound socket shared with other connections (see listener.Listener),
+            # which owns it and feeds us our datagrams
+            self.socket = sock
+            self.sender = None
+            self.receiver = None
+        self._tx_batch = None  # (header, payload, addr) to send together, None to send at once
         self.timeout = timeout
-        self.connected = False
-        self.closing = False  # flag for connection termination
+        self.clock = time.monotonic
+        self.random = random  # sequence numbers, connection ids and error simulation
+        self.on_event = None  # optional callback(connection, event, details), see emit()
+        self._state = CLOSED
 
         # Error simulation parameters
         self.simulate_packet_loss = False
@@ -23,29 +209,182 @@ class ReliableUDP:
         self.simulate_corruption = False
         self.corruption_rate = 0.0
 
-        # Retransmission parameters
+        # Retransmission parameters. timeout is the initial RTO until the RTT has been
+        # measured, and a segment is never given up on sooner than that.
         self.max_retransmissions = 5
-        self.retransmission_count = 0
+        self.max_idle_timeouts = 10  # receive/accept give up after this many silent timeouts
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+        # Delayed ACKs: acknowledge every delayed_ack_segments in-order segments, or
+        # after delayed_ack_timeout seconds, unless outgoing data carries the ACK first.
+        # A timeout of 0 acknowledges every segment immediately.
+        if delayed_ack_segments < 1 or delayed_ack_timeout < 0:
+            raise ValueError("Delayed ACK needs at least one segment and a non-negative timeout")
+        self.delayed_ack_segments = delayed_ack_segments
+        self.delayed_ack_timeout = delayed_ack_timeout
 
         # Debugging parameters
         self.debug = False
 
-    def calculate_checksum(self, data):
-        return hashlib.md5(data.encode()).hexdigest()
+        # Binary packet codec; checksum is one of packet.CHECKSUMS ("crc32", "internet", "md5")
+        self.codec = PacketCodec(checksum)
+        self.legacy_peer_detected = False
+
+        # Maximum segment size: payload bytes per packet; larger messages are segmented
+        if not 0 < mss <= MAX_PAYLOAD - STREAM_HEADER.size:
+            raise ValueError(f"MSS must be between 1 and {MAX_PAYLOAD - STREAM_HEADER.size}")
+        self.mss = mss
+
+        # Windowing: stop-and-wait is a window of one segment
+        if mode not in MODES:
+            raise ValueError(f"Mode must be one of {MODES}")
+        if window_size < 1:
+            raise ValueError("Window size must be at least 1")
+        self.mode = mode
+        self.window_size = 1 if mode == STOP_AND_WAIT else window_size
+
+        # Congestion control: one of congestion.CONGESTION_CONTROLLERS ("reno", "cubic", "bbr")
+        make_controller(congestion)  # validate the name now rather than on connect
+        self.congestion = congestion
+
+        # Pacing: new segments are spread out at the congestion controller's pacing rate
+        # (if pacing), capped at rate_limit payload bytes per second (if set), instead
+        # of going out in bursts as soon as the windows open
+        if rate_limit is not None and rate_limit <= 0:
+            raise ValueError("Rate limit must be positive")
+        self.pacing = pacing
+        self.rate_limit = rate_limit
+
+        # Flow control: bytes of received data we hold for the application, advertised
+        # to the peer as a window of MSS-sized segments
+        if receive_buffer < mss:
+            raise ValueError("Receive buffer must hold at least one segment")
+        self.receive_buffer = receive_buffer
+        self.reset_connection_state()
 
-    def false_checksum(self, checksum):
+    def reset_connection_state(self):
+        """Clear sequence numbers and buffers before a new connection."""
+        self.snd_una = 0  # oldest unacknowledged sequence number
+        self.snd_nxt = 0  # next sequence number to send
+        self.conn_id = 0  # picked by the connecting side, echoed in every packet
+        self.rcv_nxt = 0  # next sequence number expected from the peer
+        self.failed = False
+        self.fin_received = False
+        self.time_wait_until = None
+        self.rtt = RTTEstimator(self.timeout, self.min_rto, self.max_rto, self.delayed_ack_timeout)
+        self.cc = make_controller(self.congestion)
+        self.snd_wnd = 1  # peer's advertised window, until its SYN or SYNACK arrives
+        self.advertised_window = None  # window in the last packet we sent
+        self.ack_pending = 0  # in-order segments received since we last sent an ACK
+        self.ack_deadline = None  # when the delayed ACK must go out, None if none is pending
+        self._buffered = 0  # bytes delivered in order but not yet read by receive()
+        self.dup_acks = 0
+        self.highest_sacked = None  # end of the highest SACK block seen
+        self.recovery_point = None  # snd_nxt when fast recovery started, None outside it
+        self.recovery_started = 0.0
+        self.timeout_started = None  # when the last retransmission timeout was handled
+        self.pacer = TokenBucket()  # payload bytes, at send_rate()
+        self.pace_at = None  # when the pacer lets the next queued segment go, None if not waiting for it
+        self.send_limited = False  # the last send ran out of data or was held back by rate_limit
+        self._send_queue = deque()  # (flags, data) not yet given a sequence number, or a streamed message's segments
+        self._unacked = OrderedDict()  # seq -> Segment, ordered by last transmission time
+        self._out_of_order = {}  # seq -> (flags, data), Selective Repeat receive buffer; None for an STM segment
+        self._streams = {0: self.stream_class(self, 0, self._send_queue)}  # control packets queue on stream 0
+        self._rotation = deque([0])  # ids of the streams taking turns to send
+        self._accepted = deque()  # streams the peer opened, for accept_stream()
+        self._next_stream_id = 1  # odd for the connecting side, even for the accepting one
+        self.streams_enabled = False  # stream 0 data is flagged STM too, once either side uses streams
+        self._waiting_messages = 0  # complete messages across all streams
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        old, self._state = self._state, state
+        if self.on_event and old != state:
+            self.on_event(self, "state", {"old": old, "new": state})
+
+    @property
+    def connected(self):
+        return self.state in (ESTABLISHED, FIN_WAIT)
+
+    @property
+    def cwnd(self):
+        """Congestion window in segments."""
+        return self.cc.cwnd
+
+    @property
+    def ssthresh(self):
+        return self.cc.ssthresh
+
+    @property
+    def pacing_rate(self):
+        """Segments per second the congestion controller would pace at, None if unknown."""
+        return self.cc.pacing_rate
+
+    def send_rate(self):
+        """Payload bytes per second to pace new segments at, None to send as fast as the windows allow.
+
+        The pacer never goes below a window per smoothed RTT, so that a collapsed
+        bandwidth estimate cannot hold the sender under its window-limited rate.
+        """
+        rate = None
+        if self.pacing and self.cc.pacing_rate:
+            rate = self.cc.pacing_rate
+            if self.cc.srtt:
+                rate = max(rate, self.cc.cwnd / self.cc.srtt)
+            rate *= self.mss
+        if self.rate_limit is not None and (rate is None or rate > self.rate_limit):
+            rate = self.rate_limit
+        return rate
+
+    def false_checksum(self, packet):
         """Simulate a false checksum for testing purposes."""
-        chars = list(checksum)
-        position = random.randint(0, len(chars)-1)
-        chars[position] = random.choice('0123456789abcdef')
-        return ''.join(chars)
-        
+        corrupted = bytearray(packet)
+        position = PacketCodec.CHECKSUM_OFFSET + self.random.randrange(self.codec.digest_size)
+        corrupted[position] ^= self.random.randint(1, 255)
+        return bytes(corrupted)
+
     def set_debug_mode(self, debug):
         self.debug = debug
-    
-    def debug_print(self, message):
+
+    def debug_print(self, message, *args):
+        """Print message % args in debug mode; nothing is formatted otherwise."""
         if self.debug:
-            print(f"[DEBUG] {message}")
+            print("[DEBUG] " + (message % args if args else message))
+
+    def emit(self, event, **details):
+        """Report an event to the on_event hook, if one is set.
+
+        Events: "state" (old, new), "retransmit" (seq, retransmits), "timeout" (seq, rto),
+        "fast_retransmit" (ack), "checksum_failure" (addr), "rtt_sample" (rtt, srtt, rto)
+        and "failed".
+        """
+        if self.on_event:
+            self.on_event(self, event, details)
+
+    def stats(self):
+        """Snapshot of the connection's counters and its current windows and RTT estimate."""
+        snapshot = dict(self.counters)
+        snapshot.update(
+            state=self.state,
+            cwnd=self.cc.cwnd,
+            ssthresh=self.cc.ssthresh,
+            pacing_rate=self.cc.pacing_rate,
+            in_flight=len(self._unacked),
+            in_flight_bytes=sum(len(segment.data) for segment in self._unacked.values()),
+            srtt=self.rtt.srtt,
+            rttvar=self.rtt.rttvar,
+            rto=self.rtt.rto,
+            send_window=self.snd_wnd,
+            receive_window=self.advertised_window,
+            buffered=self._buffered,
+        )
+        return snapshot
 
     def configure_error_simulation(self, packet_loss_rate=0.0, corruption_rate=0.0):
         if 0 <= packet_loss_rate <= 1.0:
@@ -53,264 +392,779 @@ class ReliableUDP:
             self.packet_loss_rate = packet_loss_rate
         else:
             raise ValueError("Packet loss rate must be between 0 and 1")
-            
+
         if 0 <= corruption_rate <= 1.0:
             self.simulate_corruption = corruption_rate > 0
             self.corruption_rate = corruption_rate
         else:
             raise ValueError("Corruption rate must be between 0 and 1")
-            
-        self.debug_print(f"Packet loss rate set to {self.packet_loss_rate}, Corruption rate set to {self.corruption_rate}")
-      
-    def make_packet(self, data, seq, flags="DAT"):
-        checksum = self.calculate_checksum(data)
-
-        # Simulate packet corruption if enabled
-        if self.simulate_corruption and random.random() < self.corruption_rate:
-            self.debug_print("Simulating packet corruption")
-            checksum = self.false_checksum(checksum)
 
-        packet = {
-            "seq": seq,
-            "ack": self.ack,
-            "flags": flags,
-            "data": data,
-            "checksum": checksum
-        }
-        return json.dumps(packet).encode()
+        self.debug_print("Packet loss rate set to %s, Corruption rate set to %s",
+                         self.packet_loss_rate, self.corruption_rate)
+
+    def receive_window(self):
+        """Segments past rcv_nxt that the receive buffer still has room for.
+
+        Until a complete message is waiting, reading cannot free anything, so the
+        message being reassembled may outgrow the buffer rather than stall.
+        """
+        if not self._waiting_messages:
+            return min(self.receive_buffer // self.mss, MAX_WINDOW)
+        free = max(self.receive_buffer - self._buffered, 0)
+        return min(free // self.mss, MAX_WINDOW)
+
+    def ack_fields(self):
+        """(ack, window) for an outgoing packet.
+
+        Every packet carries the cumulative ACK, so a pending delayed ACK rides along.
+        """
+        self.ack_pending = 0
+        self.ack_deadline = None
+        self.advertised_window = self.receive_window()
+        return self.rcv_nxt, self.advertised_window
 
     def parse_packet(self, packet_bytes):
         try:
-            packet = json.loads(packet_bytes.decode())
-            required_fields = ["seq", "ack", "flags", "data", "checksum"]
-            if not all(field in packet for field in required_fields):
-                self.debug_print("Malformed packet: missing required fields")
-                return None
-                
-            calc_checksum = self.calculate_checksum(packet["data"])
-            if calc_checksum != packet["checksum"]:
-                self.debug_print(f"Checksum mismatch: expected {calc_checksum}, got {packet['checksum']}")
-                return None
-            return packet
-        except Exception as e:
-            self.debug_print(f"Error parsing packet: {e}")
+            return self.codec.decode(packet_bytes)
+        except PacketError as e:
+            self.debug_print("Error parsing packet: %s", e)
             return None
 
+    def check_legacy_peer(self, packet_bytes, addr):
+        """Detect a peer still using the JSON encoding during the handshake."""
+        if is_legacy_json(packet_bytes):
+            self.legacy_peer_detected = True
+            self.debug_print("Legacy JSON peer detected at %s, ignoring its packets", addr)
+            return True
+        return False
+
     def should_simulate_packet_loss(self):
         """Determine if packet loss should be simulated."""
         # True if packet should be "lost", False otherwise
-        if self.simulate_packet_loss and random.random() < self.packet_loss_rate:
+        if self.simulate_packet_loss and self.random.random() < self.packet_loss_rate:
             self.debug_print("Simulating packet loss")
             return True
         return False
-    
-    def send(self, data, flags="DAT"):
-        if not self.remote_addr:
-            raise ValueError("Remote address not set")
-        packet = self.make_packet(data, self.seq, flags)
-        self.retransmission_count = 0
 
-        while self.retransmission_count < self.max_retransmissions:
-            if self.should_simulate_packet_loss():
-                self.debug_print(f"Simulating packet loss (seq={self.seq}, flags={flags})")
-                time.sleep(self.timeout)  # Simulate timeout
-            else:
-                self.socket.sendto(packet, self.remote_addr)
-                self.debug_print(f"Packet sent (seq={self.seq}, flags={flags})")
-            
-            try:
-                response, addr = self.socket.recvfrom(4096)
-                ack_packet = self.parse_packet(response)
-                
-                if not ack_packet:
-                    self.debug_print("Corrupted packet received, retransmitting...")
-                    self.retransmission_count += 1
-                    continue
-                
-                # Handle simultaneous close: if we're sending FIN and receive a FIN from peer
-                if flags == "FIN" and ack_packet["flags"] == "FIN":
-                    self.debug_print(f"Simultaneous close detected, sending FINACK")
-                    self.send_finack(ack_packet["seq"])
-                    # We're already trying to close, so just consider this success
-                    self.seq = 1 - self.seq
-                    self.connected = False
-                    return True
-                    
-                # For handshake, handle SYNACK response differently
-                if flags == "SYN" and ack_packet["flags"] == "SYNACK":
-                    self.debug_print(f"SYNACK received (seq={ack_packet['seq']}, ack={ack_packet['ack']})")
-                    self.ack = ack_packet['seq']
-                    # Send ACK for SYNACK
-                    self.send_ack(ack_packet["seq"])
-                    self.seq = 1 - self.seq  # Toggle sequence number
-                    self.connected = True
-                    return True
-                    
-                # Regular ACK handling
-                elif ack_packet["flags"] == "ACK" and ack_packet["ack"] == self.seq:
-                    self.debug_print(f"ACK received (ack={ack_packet['ack']})")
-                    self.seq = 1 - self.seq  # Toggle sequence number (0/1 for Stop-and-Wait)
-                    return True
-                    
-                # Handle FIN-ACK
-                elif flags == "FIN" and ack_packet["flags"] == "FINACK":
-                    self.debug_print(f"FINACK received")
-                    self.send_ack(ack_packet["seq"]) # ACK from the client (to confirm clean close)
-                    self.connected = False
-                    return True
-                    
-                else:
-                    self.debug_print(f"Invalid ACK received (expected ack={self.seq}, got ack={ack_packet['ack']}, flags={ack_packet['flags']})")
-                    
-            except socket.timeout:
-                self.retransmission_count += 1
-                self.debug_print(f"Timeout #{self.retransmission_count}, retransmitting...")
-                
-                if self.retransmission_count >= self.max_retransmissions:
-                    self.debug_print("Maximum retransmissions reached, connection failed")
-                    return False
-        return False
+    def transmit(self, header, payload=b""):
+        """Hand an encoded header and its payload to the network, applying error simulation."""
+        self.counters["packets_sent"] += 1
+        self.counters["bytes_sent"] += len(header) + len(payload)
+        if self.should_simulate_packet_loss():
+            return
+        if self.simulate_corruption and self.random.random() < self.corruption_rate:
+            self.debug_print("Simulating packet corruption")
+            header = self.false_checksum(header)
+        if self._tx_batch is not None:
+            self._tx_batch.append((header, payload, self.remote_addr))
+        else:
+            self.send_datagram(header, payload)
+
+    def start_batch(self):
+        """Collect transmitted packets until send_batch(), which flush() calls."""
+        if self._tx_batch is None:
+            self._tx_batch = []
+
+    def send_batch(self):
+        batch, self._tx_batch = self._tx_batch, None
+        if batch:
+            self.send_datagrams(batch)
+
+    def send_datagrams(self, datagrams):
+        """Send (header, payload, addr) datagrams, as many per system call as the sender allows."""
+        sent = self.sender.send(datagrams) if self.sender else 0
+        for header, payload, _ in datagrams[sent:]:
+            self.send_datagram(header, payload)
+
+    def send_datagram(self, header, payload):
+        if payload and HAVE_SENDMSG:
+            self.socket.sendmsg((header, payload), (), 0, self.remote_addr)
+        else:
+            self.socket.sendto(header + payload, self.remote_addr)
+
+    def recv_datagram(self, timeout):
+        """Wait up to timeout seconds for a datagram; (None, None) on timeout.
+
+        The datagram is a memoryview of the receive buffer, valid until the next call.
+        """
+        if timeout <= 0:
+            return None, None
+        self.socket.settimeout(timeout)
+        try:
+            size, addr = self.socket.recvfrom_into(self._recv_buffer)
+        except socket.timeout:
+            return None, None
+        return self._recv_view[:size], addr
+
+    def recv_ready(self):
+        """Datagrams already queued behind the one just received, read without waiting."""
+        return self.receiver.recv() if self.receiver else []
+
+    def queue_message(self, data, stream_id=0):
+        """Split a message into MSS-sized segments; the last one carries EOM."""
+        queue = self.stream_queue(stream_id)
+        view = memoryview(data)
+        for offset in range(0, max(len(view), 1), self.mss):
+            end = offset + self.mss
+            flags = DAT | EOM if end >= len(view) else DAT
+            queue.append((flags, view[offset:end]))
 
-    def receive(self, expected_flags=None):
-        max_attempts = 10  
-        attempts = 0
-        
-        while attempts < max_attempts:
-            attempts += 1
-            try:
-                packet_bytes, addr = self.socket.recvfrom(4096)
-                packet = self.parse_packet(packet_bytes)
-                
-                if not packet:
-                    self.debug_print("Corrupted packet received, waiting for retransmission...")
+    def queue_data(self, data, stream_id=0):
+        """Queue a message: bytes-like (str is UTF-8 encoded) or an iterable of bytes-like chunks."""
+        if isinstance(data, str):
+            data = data.encode()
+        try:
+            view = memoryview(data)
+        except TypeError:
+            self.queue_stream(data, stream_id)
+        else:
+            self.queue_message(view, stream_id)
+
+    def queue_stream(self, chunks, stream_id=0):
+        """Queue a message whose chunks are only read as the windows open for its segments."""
+        self.stream_queue(stream_id).append(self.segment_stream(chunks))
+
+    def stream_queue(self, stream_id):
+        """Send queue of a stream, which joins the round-robin if it is not already in it."""
+        stream = self._streams[stream_id]
+        if stream_id and not stream.scheduled:
+            stream.scheduled = True
+            self._rotation.append(stream_id)
+        return stream.send_queue
+
+    def segment_stream(self, chunks):
+        """(flags, data) MSS-sized segments cut from chunks; the last one carries EOM.
+
+        One segment is held back until the next shows it is not the last, so at
+        most a chunk and a segment are buffered whatever the message size.
+        """
+        mss = self.mss
+        held = None
+        partial = bytearray()
+        for chunk in chunks:
+            view = memoryview(chunk.encode() if isinstance(chunk, str) else chunk)
+            if partial:
+                take = mss - len(partial)
+                partial += view[:take]
+                view = view[take:]
+                if len(partial) < mss:
                     continue
-                    
-                self.debug_print(f"Packet received (seq={packet['seq']}, flags={packet['flags']})")
-                
-                # Handle specific flag expectations
-                if expected_flags and packet["flags"] != expected_flags:
-                    self.debug_print(f"Unexpected flags: got {packet['flags']}, expected {expected_flags}")
-                    # For SYN when expecting something else, start connection handling
-                    if packet["flags"] == "SYN":
-                        self.remote_addr = addr
-                        self.handle_syn(packet)
-                        continue
-                    else:
-                        # Send ACK but don't return for unexpected flags
-                        self.send_ack(packet["seq"])
-                        continue
-                
-                # Special handling for SYN
-                if packet["flags"] == "SYN":
-                    self.remote_addr = addr
-                    return self.handle_syn(packet)
-                
-                # Special handling for FIN
-                if packet["flags"] == "FIN":
-                    self.remote_addr = addr
-                    # Check if we're also in the process of closing
-                    if self.closing:
-                        self.debug_print("Detected simultaneous close in receive")
-                        self.send_finack(packet["seq"])
-                        self.connected = False
-                        return ""
-                    else:
-                        return self.handle_fin(packet)
-                
-                # Normal data packet handling
-                if packet["seq"] == self.seq:
-                    self.remote_addr = addr
-                    self.send_ack(packet["seq"])  # Send ACK for the received sequence
-                    self.seq = 1 - self.seq  # Toggle sequence for next expected packet
-                    return packet["data"]
+                if held is not None:
+                    yield DAT, held
+                held, partial = bytes(partial), bytearray()
+            whole = len(view) - len(view) % mss
+            for offset in range(0, whole, mss):
+                if held is not None:
+                    yield DAT, held
+                held = view[offset:offset + mss]
+            partial += view[whole:]
+        if partial:
+            if held is not None:
+                yield DAT, held
+            held = bytes(partial)
+        yield DAT | EOM, b"" if held is None else held
+
+    def next_queued(self):
+        """(stream, (flags, data)) to send next, None if nothing is queued.
+
+        Streams with something queued take turns, a segment at a time; send_window()
+        moves the turn on. A FIN waits until every stream has sent its data.
+        """
+        rotation = self._rotation
+        checked = 0
+        while checked < len(rotation):
+            stream = self._streams[rotation[0]]
+            head = self.queue_head(stream.send_queue)
+            if head is None and stream.id:
+                rotation.popleft()  # rejoins when more is queued
+                stream.scheduled = False
+                continue
+            if head is not None and not (head[0] & FIN and len(rotation) > 1):
+                return stream, head
+            rotation.rotate(-1)
+            checked += 1
+        return None
+
+    def queue_head(self, queue):
+        """The (flags, data) at the head of a send queue, None if it is empty.
+
+        A streamed message at the head has its next segment cut off and put in front of it.
+        """
+        while queue:
+            head = queue[0]
+            if type(head) is tuple:
+                return head
+            segment = next(head, None)
+            if segment is None:
+                queue.popleft()
+                continue
+            if segment[0] & EOM:
+                queue.popleft()
+            queue.appendleft(segment)
+            return segment
+        return None
+
+    def flush(self):
+        """Send queued segments while the send, receive and congestion windows have room.
+
+        The send window and the peer's advertised window bound what the receiver must
+        buffer; the congestion window bounds the segments actually outstanding in the
+        network (SACKed ones are not). When the peer advertises a zero window and nothing
+        is in flight, one segment still goes out as a probe; its retransmission timer
+        then acts as the persist timer.
+
+        Everything transmitted since start_batch(), and the new segments, go out as
+        one batch.
+
+        The pacer holds back segments the windows would allow until it has the
+        tokens for them; next_timeout() then says when to flush again.
+        """
+        self.start_batch()
+        try:
+            self.send_window()
+        finally:
+            self.send_batch()
+
+    def send_window(self):
+        cwnd = max(int(self.cc.cwnd), 1)
+        window = min(self.window_size, self.snd_wnd)
+        now = self.clock()
+        rate = self.send_rate()
+        if rate != self.pacer.rate:
+            self.pacer.configure(rate, pacing_burst(rate, self.mss) if rate else 0, now)
+        self.pace_at = None
+        self.send_limited = False
+        while len(self._unacked) < cwnd:
+            queued = self.next_queued()
+            if queued is None:
+                self.send_limited = True  # application-limited: the windows had room to spare
+                break
+            stream, (flags, data) = queued
+            if flags & DAT and seq_diff(self.snd_nxt, self.snd_una) >= window:
+                if self._unacked:
+                    break
+                self.debug_print("Peer advertised a zero window, sending a window probe")
+            elif seq_diff(self.snd_nxt, self.snd_una) >= self.window_size:
+                break
+            wait = self.pacer.wait_time(len(data), now)
+            if wait:
+                self.pace_at = now + wait
+                self.send_limited = rate == self.rate_limit
+                break
+            stream.send_queue.popleft()
+            self._rotation.rotate(-1)
+            extension = b""
+            if flags & DAT:
+                if stream.id or self.streams_enabled:
+                    flags |= STM
+                    extension = STREAM_HEADER.pack(stream.id, stream.send_seq)
+                stream.send_seq = seq_add(stream.send_seq, 1)
+            segment = Segment(self.snd_nxt, flags, data, extension, stream.id)
+            self.snd_nxt = seq_add(self.snd_nxt, 1)
+            self._unacked[segment.seq] = segment
+            self.send_segment(segment)
+
+    def send_segment(self, segment):
+        segment.sent_at = self.clock()
+        if segment.first_sent_at is None:
+            segment.first_sent_at = segment.sent_at
+        # Retransmissions are not held back, but they do use up the pacer's tokens
+        self.pacer.consume(len(segment.data), segment.sent_at)
+        ack = self.ack_fields()
+        if segment.header_ack != ack:
+            segment.header = self.codec.encode_header(segment.flags, self.conn_id, segment.seq, *ack, segment.data,
+                                                      segment.extension)
+            segment.header_ack = ack
+        self.transmit(segment.header, segment.data)
+        self.debug_print("Packet sent (seq=%s, flags=%s, retransmits=%s)",
+                         segment.seq, flag_names(segment.flags), segment.retransmits)
+
+    def retransmit(self, segment, counted=True):
+        """Resend a segment; False if it has run out of retransmissions and the connection failed.
+
+        An uncounted retransmission does not bring the segment closer to that limit.
+        """
+        if (counted and segment.attempts >= self.max_retransmissions
+                and self.clock() - segment.first_sent_at >= self.timeout):
+            self.debug_print("Maximum retransmissions reached, connection failed")
+            self.fail()
+            return False
+        segment.retransmits += 1
+        if counted:
+            segment.attempts += 1
+        self.counters["retransmissions"] += 1
+        if self.on_event:
+            self.emit("retransmit", seq=segment.seq, retransmits=segment.retransmits)
+        self._unacked.move_to_end(segment.seq)
+        self.send_segment(segment)
+        return True
+
+    def next_timeout(self):
+        """Seconds until the retransmission, delayed ACK or pacing timer fires, None if none is armed."""
+        if self.state == TIME_WAIT:
+            return self.time_wait_until - self.clock()
+        deadline = self.ack_deadline
+        if self.pace_at is not None and (deadline is None or self.pace_at < deadline):
+            deadline = self.pace_at
+        if self._unacked:
+            oldest = next(iter(self._unacked.values()))
+            expires = oldest.sent_at + self.rtt.rto
+            if deadline is None or expires < deadline:
+                deadline = expires
+        if deadline is None:
+            return None
+        return deadline - self.clock()
+
+    def check_timers(self):
+        """Send a due delayed ACK and retransmit segments whose timer has expired.
+
+        Go-Back-N (and stop-and-wait) resend everything in flight; Selective
+        Repeat resends only the expired segments. Paced segments expire one
+        after another: those last sent before the previous timeout are resent
+        without backing off or cutting the window again.
+        """
+        now = self.clock()
+        if self.state == TIME_WAIT:
+            if now >= self.time_wait_until:
+                self.state = CLOSED
+            return
+        if self.ack_deadline is not None and now >= self.ack_deadline:
+            self.send_ack()
+        expired = []
+        for segment in self._unacked.values():
+            if segment.sent_at + self.rtt.rto > now:
+                break
+            expired.append(segment)
+        if not expired:
+            return
+        if self.timeout_started is None or any(segment.sent_at >= self.timeout_started for segment in expired):
+            self.timeout_started = now
+            self.rtt.backoff()
+            self.counters["timeouts"] += 1
+            self.emit("timeout", seq=expired[0].seq, rto=self.rtt.rto)
+            if self.snd_wnd > 0:  # an unanswered window probe is not a sign of congestion
+                self.cc.on_loss(len(self._unacked), now, timeout=True)
+            self.dup_acks = 0
+            # The resent segments draw duplicate ACKs for what is already being
+            # recovered; none below snd_nxt may start a fast retransmit (RFC 6582)
+            self.recovery_point = self.snd_nxt
+            self.recovery_started = now
+        self.debug_print("Timeout, retransmitting from seq=%s (rto=%.3fs)", expired[0].seq, self.rtt.rto)
+        if self.mode != SELECTIVE_REPEAT:
+            self.go_back(sorted(self._unacked.values(), key=lambda s: seq_diff(s.seq, self.snd_una)))
+            return
+        for segment in expired:
+            if not self.retransmit(segment):
+                return
+
+    def go_back(self, segments):
+        """Resend a Go-Back-N window in order; only its first segment counts as a retransmission attempt."""
+        for index, segment in enumerate(segments):
+            if not self.retransmit(segment, counted=index == 0):
+                return
+
+    def on_ack(self, packet):
+        """Process the cumulative acknowledgement and any SACK blocks."""
+        ack = packet.ack
+        now = self.clock()
+        acked = 0
+        newest = None  # most recently sent segment this ACK covers, for the RTT sample
+        advanced = seq_lt(self.snd_una, ack) and not seq_lt(self.snd_nxt, ack)
+        old_window = self.snd_wnd
+        if not seq_lt(ack, self.snd_una) and not seq_lt(self.snd_nxt, ack):
+            self.snd_wnd = packet.window  # ignore the window of reordered, older ACKs
+        if advanced:
+            while self.snd_una != ack:
+                segment = self._unacked.pop(self.snd_una, None)
+                if segment:
+                    acked += 1
+                    if newest is None or segment.sent_at > newest.sent_at:
+                        newest = segment
+                self.snd_una = seq_add(self.snd_una, 1)
+            self.debug_print("ACK received (ack=%s)", ack)
+        if packet.flags == ACK and packet.data:
+            for start, end in decode_sack(packet.data):
+                if not seq_lt(self.snd_una, end) or seq_lt(self.snd_nxt, end):
+                    continue  # stale or bogus block
+                seq = self.snd_una if seq_lt(start, self.snd_una) else start
+                while seq != end:
+                    segment = self._unacked.pop(seq, None)
+                    if segment:
+                        acked += 1
+                        if newest is None or segment.sent_at > newest.sent_at:
+                            newest = segment
+                    seq = seq_add(seq, 1)
+                if self.highest_sacked is None or seq_lt(self.highest_sacked, end):
+                    self.highest_sacked = end
+        # Karn's rule: an ACK for a retransmitted segment is ambiguous, so skip it
+        if newest and newest.retransmits == 0:
+            rtt = now - newest.sent_at
+            self.rtt.sample(rtt)
+            self.cc.on_rtt(rtt, now)
+            self.counters["rtt_samples"] += 1
+            if self.on_event:
+                self.emit("rtt_sample", rtt=rtt, srtt=self.rtt.srtt, rto=self.rtt.rto)
+        if acked:
+            self.cc.on_ack(acked, len(self._unacked), now, limited=self.send_limited)
+
+        if advanced:
+            self.dup_acks = 0
+            if self.recovery_point is not None:
+                if seq_lt(ack, self.recovery_point):
+                    self.retransmit_holes()  # partial ACK: the next hole is lost too
                 else:
-                    self.debug_print("Duplicate packet, re-ACKing")
-                    self.send_ack(packet["seq"])  # Resend ACK if duplicated
-                    
-            except socket.timeout:
+                    self.recovery_point = None
+        elif (packet.flags == ACK and ack == self.snd_una and self._unacked
+              and self.snd_wnd == old_window and self.snd_wnd > 0):
+            # A window update or an answer to a window probe is not a duplicate ACK
+            self.dup_acks += 1
+            if self.dup_acks == DUP_ACK_THRESHOLD and self.recovery_point is None:
+                self.debug_print("Fast retransmit after %s duplicate ACKs (ack=%s)", self.dup_acks, ack)
+                self.recovery_point = self.snd_nxt
+                self.recovery_started = now
+                self.counters["fast_retransmits"] += 1
+                self.emit("fast_retransmit", ack=ack)
+                self.cc.on_loss(len(self._unacked), now)
+                self.retransmit_holes()
+
+        probe = self._unacked.get(self.snd_una)
+        if probe and self.snd_wnd == 0:
+            # The peer is alive but has no room yet: keep probing without giving up.
+            # retransmits stays non-zero so that Karn's rule still applies.
+            probe.retransmits = probe.attempts = 1
+        elif probe and old_window == 0:
+            self.debug_print("Peer window reopened (%s segments), resending the probe", self.snd_wnd)
+            self.retransmit(probe)
+
+    def retransmit_holes(self):
+        """Resend the segments the receiver is missing, without waiting for the RTO.
+
+        With SACK information these are the unacknowledged segments below the highest
+        SACKed one; Go-Back-N has none, so it resends everything in flight. Segments
+        already resent during this recovery are skipped.
+        """
+        if self.mode != SELECTIVE_REPEAT:
+            holes = list(self._unacked.values())
+        elif self.highest_sacked is not None and seq_lt(self.snd_una, self.highest_sacked):
+            holes = [s for s in self._unacked.values() if seq_lt(s.seq, self.highest_sacked)]
+        else:
+            holes = [self._unacked[self.snd_una]] if self.snd_una in self._unacked else []
+        holes.sort(key=lambda s: seq_diff(s.seq, self.snd_una))
+        holes = [segment for segment in holes if segment.sent_at < self.recovery_started]
+        if self.mode != SELECTIVE_REPEAT:
+            self.go_back(holes)
+            return
+        for segment in holes:
+            if not self.retransmit(segment):
+                return
+
+    def fail(self):
+        self.failed = True
+        self.state = CLOSED
+        self.emit("failed")
+        for stream in self._streams.values():
+            stream.send_queue.clear()
+        self._unacked.clear()
+
+    def on_data(self, packet):
+        seq = packet.seq
+        window = self.receive_window()
+        delay = False
+        if seq_lt(seq, self.rcv_nxt):
+            self.counters["duplicates"] += 1
+            self.debug_print("Duplicate packet, re-ACKing")
+        elif seq_diff(seq, self.rcv_nxt) >= window:
+            self.debug_print("Packet beyond receive window discarded (seq=%s, window=%s)", seq, window)
+        elif seq == self.rcv_nxt:
+            self.deliver(packet.flags, packet.data)
+            self.rcv_nxt = seq_add(self.rcv_nxt, 1)
+            # An in-order segment that fills no hole may wait for a reply to carry its ACK
+            delay = not self._out_of_order
+            # Drain any buffered segments that are now in order
+            while self.rcv_nxt in self._out_of_order:
+                buffered = self._out_of_order.pop(self.rcv_nxt)
+                if buffered:
+                    self.deliver(*buffered)
+                self.rcv_nxt = seq_add(self.rcv_nxt, 1)
+        elif self.mode == SELECTIVE_REPEAT:
+            if seq in self._out_of_order:
+                self.counters["duplicates"] += 1
+            elif packet.flags & STM:
+                # Its stream need not wait for the hole: deliver it now and keep just its place
+                self.debug_print("Out-of-order stream packet delivered (seq=%s, expected=%s)", seq, self.rcv_nxt)
+                self.deliver(packet.flags, packet.data)
+                self._out_of_order[seq] = None
+            else:
+                self.debug_print("Out-of-order packet buffered (seq=%s, expected=%s)", seq, self.rcv_nxt)
+                self._out_of_order[seq] = (packet.flags, bytes(packet.data))
+        else:
+            self.debug_print("Out-of-order packet discarded (seq=%s, expected=%s)", seq, self.rcv_nxt)
+        if delay:
+            self.delay_ack(packet.flags)
+        else:
+            # Out-of-order, duplicate and hole-filling segments are ACKed at once (RFC 5681)
+            self.send_ack(self.sack_blocks(seq))
+
+    def delay_ack(self, flags):
+        """Hold back the ACK for an in-order segment, up to delayed_ack_segments or the timeout.
+
+        A stop-and-wait peer cannot send again until it is ACKed, so only the last
+        segment of a message, which a reply may follow, is delayed in that mode.
+        """
+        self.ack_pending += 1
+        if (self.delayed_ack_timeout == 0 or self.ack_pending >= self.delayed_ack_segments
+                or (self.mode == STOP_AND_WAIT and not flags & EOM)):
+            self.send_ack()
+        elif self.ack_deadline is None:
+            self.ack_deadline = self.clock() + self.delayed_ack_timeout
+
+    def deliver(self, flags, data):
+        """Hand a payload to its stream: an STM segment by its stream header, others in order to stream 0."""
+        if not flags & STM:
+            stream = self._streams[0]
+            stream.on_segment(stream.recv_seq, flags, data)
+            return
+        if len(data) < STREAM_HEADER.size:
+            self.debug_print("Stream packet too short for its stream header, dropped")
+            return
+        stream_id, stream_seq = STREAM_HEADER.unpack_from(data)
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            self.debug_print("Peer opened stream %s", stream_id)
+            stream = self._streams[stream_id] = self.stream_class(self, stream_id)
+            self._accepted.append(stream)
+        self.streams_enabled = True
+        stream.on_segment(stream_seq, flags, data[STREAM_HEADER.size:])
+
+    def sack_blocks(self, recent_seq):
+        """[start, end) ranges held in the out-of-order buffer, for the next ACK."""
+        if not self._out_of_order:
+            return []
+        blocks = []
+        for seq in sorted(self._out_of_order, key=lambda seq: seq_diff(seq, self.rcv_nxt)):
+            if blocks and blocks[-1][1] == seq:
+                blocks[-1][1] = seq_add(seq, 1)
+            else:
+                blocks.append([seq, seq_add(seq, 1)])
+        # RFC 2018: the block holding the most recently received segment goes first
+        blocks.sort(key=lambda block: seq_diff(recent_seq, block[0]) >= seq_diff(block[1], block[0]))
+        return blocks[:MAX_SACK_BLOCKS]
+
+    def send_ack(self, sack_blocks=()):
+        sack = encode_sack(sack_blocks)
+        self.transmit(self.codec.encode_header(ACK, self.conn_id, self.snd_nxt, *self.ack_fields(), sack), sack)
+        self.debug_print("ACK sent (ack=%s, window=%s, sack=%s)", self.rcv_nxt, self.advertised_window, sack_blocks)
+
+    def handle_datagram(self, datagram, addr):
+        packet = self.parse_packet(datagram)
+        if not packet:
+            if self.state in (LISTEN, SYN_SENT) and self.check_legacy_peer(datagram, addr):
+                return
+            self.checksum_failed(addr)
+            return
+        self.debug_print("Packet received (seq=%s, flags=%s)", packet.seq, flag_names(packet.flags))
+        self.handle_packet(packet, addr)
+
+    def checksum_failed(self, addr):
+        """Count a datagram for this connection that failed to decode."""
+        self.counters["checksum_failures"] += 1
+        self.emit("checksum_failure", addr=addr)
+        self.debug_print("Corrupted packet received, waiting for retransmission...")
+
+    def handle_packet(self, packet, addr):
+        self.counters["packets_received"] += 1
+        self.counters["bytes_received"] += self.codec.header_size + len(packet.data)
+        flags = packet.flags
+        if self.state == LISTEN:
+            if flags == SYN:
+                self.handle_syn(packet, addr)
+            return
+        if addr != self.remote_addr:
+            self.debug_print("Ignoring packet from unknown peer %s", addr)
+            return
+        if packet.conn_id != self.conn_id:
+            self.debug_print("Ignoring packet for another connection (conn_id=%s)", packet.conn_id)
+            return
+
+        if flags == SYN:
+            # Our SYNACK was lost; the timer will resend it, but answer right away
+            if self.state == SYN_RCVD and self._unacked:
+                self.retransmit(next(iter(self._unacked.values())))
+            return
+        if flags == SYN | ACK:
+            if self.state == SYN_SENT:
+                self.on_ack(packet)
+                if self.snd_una == self.snd_nxt:
+                    self.debug_print("SYNACK received (seq=%s, ack=%s)", packet.seq, packet.ack)
+                    self.rcv_nxt = seq_add(packet.seq, 1)
+                    self.state = ESTABLISHED
+            # ACK the SYNACK (again, if our first ACK was lost)
+            if self.connected:
+                self.send_ack()
+            return
+
+        # Every packet after the SYN carries a valid ack field: data piggybacks its
+        # acknowledgement, and a FIN may complete an earlier send
+        self.on_ack(packet)
+        if self.state == SYN_RCVD and (self.snd_una == self.snd_nxt or flags & DAT):
+            self.debug_print("Final handshake ACK received")
+            self.state = ESTABLISHED
+        if flags & DAT and self.connected:
+            self.on_data(packet)
+        if flags & FIN:
+            self.handle_fin(packet)
+
+        # Teardown completes once both FINs have been acknowledged
+        if self.fin_received and self.snd_una == self.snd_nxt and self.all_acked():
+            if self.state == FIN_WAIT:
+                self.enter_time_wait()
+            elif self.state == LAST_ACK:
+                self.debug_print("Final ACK received")
+                self.state = CLOSED
+
+    def handle_syn(self, packet, addr):
+        self.debug_print("SYN received, sending SYNACK")
+        self.remote_addr = addr
+        self.conn_id = packet.conn_id
+        self.rcv_nxt = seq_add(packet.seq, 1)
+        self.snd_wnd = packet.window
+        self._next_stream_id = 2
+        self.state = SYN_RCVD
+        self._send_queue.append((SYN | ACK, b""))
+
+    def enter_time_wait(self):
+        self.state = TIME_WAIT
+        self.time_wait_until = self.clock() + min(TIME_WAIT_RTOS * self.rtt.rto, self.max_rto)
+
+    def handle_fin(self, packet):
+        """Handle the peer's FIN, or its FINACK: a FIN that also acknowledges ours."""
+        if packet.seq != self.rcv_nxt:
+            if seq_lt(packet.seq, self.rcv_nxt):
+                self.send_ack()  # Retransmitted FIN: our ACK for it was lost
+            return  # Otherwise data before the FIN is still missing
+        self.rcv_nxt = seq_add(self.rcv_nxt, 1)
+        self.fin_received = True
+        if self.state == FIN_WAIT:
+            if packet.flags & ACK:
+                self.debug_print("FINACK received")
+            else:
+                self.debug_print("Simultaneous close detected")
+            self.send_ack()
+        elif self.connected or self.state == SYN_RCVD:
+            # Our FINACK is a real segment: it follows any data still queued and is
+            # retransmitted until the closing peer acknowledges it
+            self.debug_print("FIN received, sending FINACK")
+            self._send_queue.append((FIN | ACK, b""))
+            self.state = LAST_ACK
+
+    def run_until(self, condition, idle_limit=None):
+        """Drive the connection until condition() holds.
+
+        Returns False if the connection fails, or after idle_limit consecutive
+        timeouts with nothing received and nothing awaiting retransmission.
+        """
+        idle = 0
+        while True:
+            self.flush()
+            if self.failed:
+                return False
+            if condition():
+                return True
+            wait = self.next_timeout()
+            datagram, addr = self.recv_datagram(self.timeout if wait is None else wait)
+            if datagram is not None:
+                idle = 0
+                # Replies wait for the flush() at the top of the loop, so handling every
+                # datagram already queued sends the resulting ACKs and segments in one batch
+                self.start_batch()
+                self.handle_datagram(datagram, addr)
+                for datagram, addr in self.recv_ready():
+                    self.handle_datagram(datagram, addr)
+            elif wait is not None:
+                self.start_batch()
+                self.check_timers()
+            else:
+                idle += 1
                 self.debug_print("Timeout while waiting for packet")
-                continue
-                
+                if idle_limit is not None and idle >= idle_limit:
+                    return False
+
+    def send(self, data):
+        """Reliably send a message (bytes, bytearray or memoryview; str is UTF-8 encoded).
+
+        data may also be an iterable of such chunks, e.g. a generator reading a
+        file, which is consumed segment by segment as the windows allow.
+        Blocks until every segment of the message has been acknowledged.
+        """
+        if not self.remote_addr:
+            raise ValueError("Remote address not set")
+        if not self.connected:
+            return False
+        self.queue_data(data)
+        return self.run_until(self.all_acked)
+
+    def all_acked(self):
+        return not self._unacked and not any(stream.send_queue for stream in self._streams.values())
+
+    def receive(self):
+        """Receive the next message as bytes, b"" once the peer has closed, None on timeout."""
+        if self.run_until(self.readable, self.max_idle_timeouts):
+            return self.pop_message()
         self.debug_print("Max receive attempts reached")
         return None
-        
-    def handle_syn(self, packet):
-        self.debug_print(f"SYN received, sending SYNACK")
-        # Send SYNACK with our sequence number
-        synack_packet = {
-            "seq": self.seq,
-            "ack": packet["seq"],
-            "flags": "SYNACK",
-            "data": "",
-            "checksum": self.calculate_checksum("")
-        }
-        
-        if not self.should_simulate_packet_loss():
-            self.socket.sendto(json.dumps(synack_packet).encode(), self.remote_addr)
-            self.debug_print(f"SYNACK sent (seq={self.seq}, ack={packet['seq']})")
-            
-            # Wait for final ACK
-            try:
-                ack_bytes, _ = self.socket.recvfrom(4096)
-                ack_packet = self.parse_packet(ack_bytes)
-                
-                if ack_packet and ack_packet["flags"] == "ACK" and ack_packet["ack"] == self.seq:
-                    self.debug_print("Final handshake ACK received")
-                    self.seq = 1 - self.seq  # Toggle sequence for next packet
-                    self.connected = True
-                    return ""  # Empty data for handshake
-            except socket.timeout:
-                self.debug_print("Timeout waiting for final handshake ACK")
-                
+
+    def readable(self):
+        return self._streams[0].readable()
+
+    def pop_message(self):
+        """Next complete message, or b"" if there is none (the peer has closed)."""
+        return self._streams[0].pop_message()
+
+    def open_stream(self):
+        """Open a new stream to send and receive messages on, alongside send() and receive().
+
+        Nothing goes on the wire until the stream sends; the peer then gets it
+        from accept_stream(). Streams are closed with the connection.
+        """
+        if not self.connected:
+            raise ValueError("Not connected")
+        stream_id = self._next_stream_id
+        while stream_id in self._streams:
+            stream_id += 2
+        if stream_id > MAX_STREAM_ID:
+            raise ValueError("No stream ids left on this connection")
+        self._next_stream_id = stream_id + 2
+        stream = self._streams[stream_id] = self.stream_class(self, stream_id)
+        self.streams_enabled = True
+        return stream
+
+    def accept_stream(self):
+        """Wait for the peer to open a stream; None on timeout or once it has closed."""
+        if self.run_until(self.stream_acceptable, self.max_idle_timeouts) and self._accepted:
+            return self._accepted.popleft()
         return None
-        
-    def handle_fin(self, packet):
-        self.debug_print(f"FIN received, sending FINACK")
-        # Send FINACK
-        self.send_finack(packet["seq"])
-        self.connected = False
-        return ""  # Empty data for connection termination
-    
-    def send_finack(self, fin_seq):
-        """Send a FINACK packet in response to a FIN."""
-        finack_packet = {
-            "seq": self.seq,
-            "ack": fin_seq,
-            "flags": "FINACK",
-            "data": "",
-            "checksum": self.calculate_checksum("")
-        }
-        
-        if not self.should_simulate_packet_loss():
-            self.socket.sendto(json.dumps(finack_packet).encode(), self.remote_addr)
-            self.debug_print(f"FINACK sent (seq={self.seq}, ack={fin_seq})")
-
-    def send_ack(self, ack_seq):
-        ack_packet = {
-            "seq": self.seq,
-            "ack": ack_seq,
-            "flags": "ACK",
-            "data": "",
-            "checksum": self.calculate_checksum("")
-        }
-        # Simulate packet loss for ACKs too
-        if not self.should_simulate_packet_loss():
-            self.socket.sendto(json.dumps(ack_packet).encode(), self.remote_addr)
-            self.debug_print(f"ACK sent (ack={ack_seq})")
-        else:
-            self.debug_print(f"Simulating ACK loss (ack={ack_seq})")
 
-    def establish_connection(self, remote_ip=None, remote_port=None):
+    def stream_acceptable(self):
+        return self._accepted or self.fin_received or self.state == CLOSED
+
+    def start_connect(self, remote_ip=None, remote_port=None):
+        """Queue a SYN with a random initial sequence number and connection id."""
         if remote_ip and remote_port:
             self.remote_addr = (remote_ip, remote_port)
-        
+
         if not self.remote_addr:
             raise ValueError("Remote address not set")
 
-        self.debug_print(f"Establishing connection to {self.remote_addr}")
+        self.debug_print("Establishing connection to %s", self.remote_addr)
+        self.reset_connection_state()
+        self.snd_una = self.snd_nxt = self.random.getrandbits(32)
+        self.conn_id = self.random.getrandbits(32)
+        self.state = SYN_SENT
+        self._send_queue.append((SYN, b""))
 
-        # Send SYN
-        success = self.send("", flags="SYN")  # empty data with SYN flag
+    def establish_connection(self, remote_ip=None, remote_port=None):
+        self.start_connect(remote_ip, remote_port)
+        success = self.run_until(lambda: self.state == ESTABLISHED)
 
         if success:
             self.debug_print("Connection established successfully")
@@ -318,34 +1172,44 @@ class ReliableUDP:
             self.debug_print("Connection failed")
         return success
 
-    
-    def accept_connection(self):
+    def start_listen(self):
         self.debug_print("Waiting for connection request")
-        
-        # Wait for SYN packet
-        data = self.receive(expected_flags="SYN")
-        if data is not None:  # Connection handshake completed in receive method
+        self.reset_connection_state()
+        self.snd_una = self.snd_nxt = self.random.getrandbits(32)
+        self.remote_addr = None
+        self.state = LISTEN
+
+    def accept_connection(self):
+        self.start_listen()
+        if self.run_until(lambda: self.state == ESTABLISHED, self.max_idle_timeouts):
             self.debug_print("Connection accepted")
-            self.connected = True
             return True
-            
+
+        self.state = CLOSED
         self.debug_print("Connection acceptance failed")
         return False
 
-    def close_connection(self):
+    def start_close(self):
+        """Queue our FIN if needed; False if there is nothing left to wait for."""
         if not self.remote_addr:
             raise ValueError("Remote address not set")
-
+        if self.state == LAST_ACK:
+            # The peer closed first: wait for our FINACK to be acknowledged
+            return True
+        if not self.connected:
+            # Already closed (or the connection failed)
+            return False
         self.debug_print("Closing connection")
-        
-        # Set closing flag to handle simultaneous close
-        self.closing = True
 
-        # Send FIN
-        success = self.send("", flags="FIN")
-        
-        self.closing = False  # Reset flag
+        # FIN goes out after any data still queued
+        self._send_queue.append((FIN, b""))
+        self.state = FIN_WAIT
+        return True
 
+    def close_connection(self):
+        if not self.start_close():
+            return not self.failed
+        success = self.run_until(lambda: self.state == CLOSED, self.max_idle_timeouts)
         if success:
             self.debug_print("Connection closed gracefully")
         else:
@@ -355,4 +1219,4 @@ class ReliableUDP:
     def close(self):
         """Close the socket."""
         self.socket.close()
-        self.debug_print("Socket closed")
\ No newline at end of file
+        self.debug_print("Socket closed")
@@ -0,0 +1,40 @@
+class RTTEstimator:
+    """Retransmission timeout from smoothed RTT measurements (RFC 6298).
+
+    Callers apply Karn's rule: only segments that were never retransmitted
+    may be passed to sample(), since their ACK is unambiguous. The peer may
+    hold an ACK back for up to max_ack_delay, which is added to the timeout
+    as QUIC does (RFC 9002).
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    GRANULARITY = 0.001  # clock granularity in seconds
+
+    def __init__(self, initial_rto=1.0, min_rto=0.01, max_rto=60.0, max_ack_delay=0.0):
+        if not 0 < min_rto <= max_rto:
+            raise ValueError("RTO bounds must satisfy 0 < min_rto <= max_rto")
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_ack_delay = max_ack_delay
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.clamp(initial_rto)
+
+    def clamp(self, rto):
+        return min(max(rto, self.min_rto), self.max_rto)
+
+    def sample(self, rtt):
+        """Fold a new RTT measurement into the estimate; resets any backoff."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = self.clamp(self.srtt + max(self.GRANULARITY, self.K * self.rttvar) + self.max_ack_delay)
+
+    def backoff(self):
+        """Double the RTO after a retransmission timeout."""
+        self.rto = self.clamp(self.rto * 2)
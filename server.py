@@ -1,99 +1,493 @@
 import os
+import sys
+import stat
+import time
+import asyncio
 import datetime
-from reliable_udp import ReliableUDP
-
-# splits the request into method, path, headers, and body
-def parse_http_request(request):
-    lines = request.strip().split('\r\n')
-    request_line = lines[0]
-    method, path, _ = request_line.split()
-    headers = {}
-    body = ''
-    i = 1
-    while i < len(lines) and lines[i]:
-        key, value = lines[i].split(': ', 1)
-        headers[key] = value
-        i += 1
-    if i + 1 < len(lines):
-        body = '\r\n'.join(lines[i+1:])
-    return method, path, headers, body
-
-def build_http_response(status_code, body, content_type='text/plain'):
-    reason_phrases = {
-        200: 'OK',
-        400: 'Bad Request',
-        404: 'Not Found'
-    }
-    reason = reason_phrases.get(status_code, 'Unknown')
-    current_date = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
-
-    response_lines = [
-        f'HTTP/1.0 {status_code} {reason}',
-        f'Date: {current_date}',
-        'Server: CustomUDPServer/1.0',
-        f'Content-Type: {content_type}; charset=utf-8',
-        f'Content-Length: {len(body)}',
-        'Connection: close',
-        '',
-        body
-    ]
-    return '\r\n'.join(response_lines)
+import tempfile
+import mimetypes
+import threading
+from collections import OrderedDict
+from listener import Listener
+from prefork import PreforkServer
+from http_parser import RequestParser, HTTPParseError, Request, NEED_DATA, END_OF_REQUEST
+from async_reliable_udp import start_server
 
+# Response cache: total bytes of file bodies it may hold, the largest file worth
+# caching, and how often a cached file is checked for changes
+CACHE_MAX_BYTES = 64 << 20
+CACHE_MAX_FILE = 8 << 20
+CACHE_CHECK_INTERVAL = 1.0
 
-def main():
-    ip = '127.0.0.1'
-    port = 8080
-    server = ReliableUDP(ip, port)
-    server.set_debug_mode(True)
-    print(f"Server is running...on IP Address = {ip} and port Number = {port}")
+# Bytes of an uncached file mapped into each chunk of a streamed response,
+# and the most read from an asyncio stream at a time
+STREAM_CHUNK = 256 << 10
 
-    while True:
-        if server.accept_connection():
-            print("Connection accepted.")
-            while server.connected:
-                data = server.receive()
-                if data:
-                    method, path, headers, body = parse_http_request(data)
-                    if method == 'GET':
-                        file_path = path.strip('/')
-                        if os.path.exists(file_path):
-                            with open(file_path, 'r') as f:
-                                content = f.read()
-                            # Check if it's an HTML file
-                            if file_path.endswith('.html'):
-                                content_type = 'text/html'
-                            else:
-                                content_type = 'text/plain'
-                            response = build_http_response(200, content, content_type)
-                        else:
-                            response = build_http_response(404, 'File not found.')
-
-                    elif method == 'POST':
-                        # Wrap the POST body in HTML tags
-                        html_content = f"""<!DOCTYPE html>
+# Where the page made from the last POST body is kept
+POST_DATA_FILE = 'post_data.html'
+
+REASON_PHRASES = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    431: 'Request Header Fields Too Large',
+    501: 'Not Implemented'
+}
+
+
+def wants_keep_alive(version, headers):
+    """HTTP/1.1 connections persist unless the client asks to close; HTTP/1.0 ones only on request."""
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+_date = [None, b'']  # (second, formatted Date header line)
+
+
+def http_date_line():
+    """The Date header line, formatted at most once per second."""
+    now = int(time.time())
+    if _date[0] != now:
+        date = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+        _date[:] = now, f'Date: {date}\r\n'.encode()
+    return _date[1]
+
+
+def build_status_line(status_code):
+    return f'HTTP/1.1 {status_code} {REASON_PHRASES.get(status_code, "Unknown")}\r\n'.encode() + http_date_line()
+
+
+def build_http_headers(content_type, length, extra_headers=()):
+    """Every header after Date up to Connection (see end_of_headers); no body headers if content_type is None."""
+    response_lines = ['Server: CustomUDPServer/1.0']
+    if content_type is not None:
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        response_lines += [f'Content-Type: {content_type}', f'Content-Length: {length}']
+    response_lines += [f'{name}: {value}' for name, value in extra_headers]
+    return ''.join(f'{line}\r\n' for line in response_lines).encode()
+
+
+def end_of_headers(keep_alive):
+    """The Connection header and the blank line that ends the headers."""
+    return b'Connection: keep-alive\r\n\r\n' if keep_alive else b'Connection: close\r\n\r\n'
+
+
+def build_http_response(status_code, body, content_type='text/plain', extra_headers=(), keep_alive=False):
+    if isinstance(body, str):
+        body = body.encode()
+    return (build_status_line(status_code) + build_http_headers(content_type, len(body), extra_headers)
+            + end_of_headers(keep_alive) + body)
+
+
+def file_chunks(f, length, chunk_size=STREAM_CHUNK):
+    """Up to the first length bytes of an open binary file in chunk_size pieces, read as they are consumed.
+
+    The file is closed at the end. Plain reads just stop early on a file
+    truncated meanwhile, where touching mmap pages past its new end would
+    kill the process with SIGBUS.
+    """
+    with f:
+        f.seek(0)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+class StreamedResponse:
+    """A response whose body is read from an open file as it is sent.
+
+    The head announces length bytes. If the file turns out shorter (it was
+    truncated while being sent), short is set once the body has been read:
+    the connection must then be closed, since the client can no longer tell
+    where the next response starts.
+    """
+
+    def __init__(self, head, f, length):
+        self.head = head
+        self.file = f
+        self.length = length
+        self.short = False
+
+    def __iter__(self):
+        yield self.head
+        sent = 0
+        for chunk in file_chunks(self.file, self.length):
+            sent += len(chunk)
+            yield chunk
+        self.short = sent < self.length
+
+
+def is_short(response):
+    """True if a response was sent with less body than its Content-Length."""
+    return isinstance(response, StreamedResponse) and response.short
+
+
+class CachedFile:
+    """A file's pre-encoded response headers and, unless it is to be streamed, its contents."""
+
+    __slots__ = ('path', 'body', 'etag', 'headers', 'mtime_ns', 'size', 'checked_at')
+
+    def __init__(self, file_path, st, checked_at, load=True):
+        self.path = file_path
+        self.body = None
+        if load:
+            with open(file_path, 'rb') as f:
+                self.body = f.read()
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size if self.body is None else len(self.body)
+        self.etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        self.headers = build_http_headers(content_type, self.size, [('ETag', self.etag)])
+        self.checked_at = checked_at
+
+    def response(self, keep_alive=False):
+        """The 200 response: bytes for a loaded file, a StreamedResponse otherwise.
+
+        A streamed file's size is taken from the open descriptor, and its
+        headers redone if it changed since it was cached. Raises OSError if
+        the file can no longer be opened.
+        """
+        if self.body is not None:
+            return build_status_line(200) + self.headers + end_of_headers(keep_alive) + self.body
+        f = open(self.path, 'rb')
+        st = os.fstat(f.fileno())
+        headers = self.headers
+        if (st.st_mtime_ns, st.st_size) != (self.mtime_ns, self.size):
+            headers = CachedFile(self.path, st, self.checked_at, load=False).headers
+        return StreamedResponse(build_status_line(200) + headers + end_of_headers(keep_alive), f, st.st_size)
+
+
+class ResponseCache:
+    """LRU cache of files served by GET, bounded by the total size of their bodies.
+
+    A cached file is checked with stat() at most once per check_interval:
+    a changed mtime or size reloads it and a missing file is dropped, so hot
+    files are otherwise served without touching the disk. Files larger than
+    max_file are not read here; their responses stream them from disk.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, max_file=CACHE_MAX_FILE, check_interval=CACHE_CHECK_INTERVAL):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.check_interval = check_interval
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # path -> CachedFile, least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        """The file as a CachedFile, loading it if needed; None if there is no such file."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self._entries.get(file_path)
+            if entry and now - entry.checked_at < self.check_interval:
+                self._entries.move_to_end(file_path)
+                self.hits += 1
+                return entry
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            self.discard(file_path)
+            return None
+        if entry and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+            with self.lock:
+                entry.checked_at = now
+                if file_path in self._entries:
+                    self._entries.move_to_end(file_path)
+                self.hits += 1
+            return entry
+        entry = CachedFile(file_path, st, now, load=st.st_size <= self.max_file)
+        with self.lock:
+            self.misses += 1
+            self._discard(file_path)
+            if entry.body is not None:
+                self._entries[file_path] = entry
+                self.total_bytes += len(entry.body)
+                while self.total_bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.total_bytes -= len(evicted.body)
+        return entry
+
+    def discard(self, file_path):
+        with self.lock:
+            self._discard(file_path)
+
+    def _discard(self, file_path):
+        entry = self._entries.pop(file_path, None)
+        if entry:
+            self.total_bytes -= len(entry.body)
+
+
+response_cache = ResponseCache()
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value lists etag (weak comparison) or is "*"."""
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+class GetHandler:
+    """Answers a GET from the response cache; a request body is ignored.
+
+    Every handler takes the body through write() as it arrives, then builds
+    the response in finish(); abort() drops a request whose body was cut off.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def write(self, chunk):
+        pass
+
+    def finish(self, keep_alive):
+        entry = response_cache.get(self.request.path.strip('/'))
+        if entry is None:
+            return build_http_response(404, 'File not found.', keep_alive=keep_alive)
+        if etag_matches(self.request.headers.get('if-none-match', ''), entry.etag):
+            return (build_status_line(304) + build_http_headers(None, 0, [('ETag', entry.etag)])
+                    + end_of_headers(keep_alive))
+        try:
+            return entry.response(keep_alive)
+        except OSError:
+            response_cache.discard(entry.path)  # removed since it was checked
+            return build_http_response(404, 'File not found.', keep_alive=keep_alive)
+
+    def abort(self):
+        pass
+
+
+class PostHandler:
+    """Writes a POST body, wrapped in HTML, to POST_DATA_FILE as it arrives and echoes the page.
+
+    The page goes to a temporary file that replaces POST_DATA_FILE once the
+    body is complete, and the response is streamed from it.
+    """
+
+    html_head = b"""<!DOCTYPE html>
 <html>
 <head>
     <title>POST Response</title>
 </head>
 <body>
     <h1>Data Received</h1>
-    <p>{body}</p>
+    <p>"""
+    html_tail = b"""</p>
 </body>
 </html>"""
 
-                        # Save it to an HTML file
-                        with open('post_data.html', 'w') as f:
-                            f.write(html_content)
+    def __init__(self, request, file_path=POST_DATA_FILE):
+        self.file_path = file_path
+        fd, self.temp_path = tempfile.mkstemp(prefix='.post_data.', dir=os.path.dirname(os.path.abspath(file_path)))
+        os.fchmod(fd, 0o644)
+        self.file = os.fdopen(fd, 'w+b')
+        self.file.write(self.html_head)
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def finish(self, keep_alive):
+        self.file.write(self.html_tail)
+        self.file.flush()
+        os.replace(self.temp_path, self.file_path)
+        length = os.fstat(self.file.fileno()).st_size
+        head = build_status_line(200) + build_http_headers('text/html', length) + end_of_headers(keep_alive)
+        return StreamedResponse(head, self.file, length)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+class ErrorHandler:
+    """Answers with an error status whatever the body."""
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.message = message
+
+    def write(self, chunk):
+        pass
+
+    def finish(self, keep_alive):
+        return build_http_response(self.status_code, self.message, keep_alive=keep_alive)
+
+    def abort(self):
+        pass
+
+
+def start_request(request):
+    """The handler for a request whose headers have been parsed."""
+    if request.method == 'GET':
+        return GetHandler(request)
+    if request.method == 'POST':
+        return PostHandler(request)
+    return ErrorHandler(400, 'Bad Request.')
+
+
+class RequestStream:
+    """Turns the bytes received on one connection into responses, in request order.
+
+    feed() returns the responses the new bytes complete; a body is passed to
+    its handler as it arrives. Once closed is set (a request did not ask for
+    keep-alive, or could not be parsed and was answered with an error), the
+    connection is to be closed after sending them.
+    """
+
+    def __init__(self):
+        self.parser = RequestParser()
+        self.handler = None
+        self.keep_alive = True
+        self.closed = False
+
+    def feed(self, data):
+        self.parser.feed(data)
+        responses = []
+        while not self.closed:
+            try:
+                event = self.parser.next_event()
+            except HTTPParseError as e:
+                self.abort()
+                self.closed = True
+                responses.append(build_http_response(e.status, f'{REASON_PHRASES[e.status]}.'))
+                break
+            if event == NEED_DATA:
+                break
+            if isinstance(event, Request):
+                self.keep_alive = wants_keep_alive(event.version, event.headers)
+                self.handler = start_request(event)
+            elif event == END_OF_REQUEST:
+                handler, self.handler = self.handler, None
+                responses.append(handler.finish(self.keep_alive))
+                self.closed = not self.keep_alive
+            else:
+                self.handler.write(event)
+        return responses
+
+    def abort(self):
+        """Drop the request in progress, if its body was cut off."""
+        if self.handler:
+            self.handler.abort()
+            self.handler = None
 
-                        # Send the HTML content as a response
-                        response = build_http_response(200, html_content, content_type='text/html')
 
-                    else:
-                        response = build_http_response(400, 'Bad Request.')
-                    server.send(response)
-                else:
+def send_responses(connection, responses):
+    """Send responses back to back, waiting once for the whole batch to be acknowledged.
+
+    Waiting after every response would also wait out the client's delayed
+    ACK each time. A streamed file ends a batch, since nothing may follow it
+    if it comes up short. Returns False once the connection must be closed.
+    """
+    for index, response in enumerate(responses):
+        connection.queue_data(response)
+        if isinstance(response, StreamedResponse) or index == len(responses) - 1:
+            if not connection.run_until(connection.all_acked):
+                return False
+            if is_short(response):
+                return False  # the response framing is lost
+    return True
+
+
+def handle_client(connection):
+    """Serve requests on one connection until either side closes it.
+
+    Requests are answered in the order they arrive, so a client may pipeline
+    several without waiting; those already received are served back to back.
+    """
+    stream = RequestStream()
+    while not stream.closed and connection.connected:
+        data = connection.receive()
+        if not data:
+            break
+        if not send_responses(connection, stream.feed(data)):
+            break
+    stream.abort()
+    connection.close_connection()
+    connection.close()
+
+
+async def handle_client_async(reader, writer):
+    """Serve requests on one asyncio stream until either side closes it."""
+    stream = RequestStream()
+    try:
+        while not stream.closed:
+            data = await reader.read(STREAM_CHUNK)
+            if not data:
+                break
+            for response in stream.feed(data):
+                writer.write(response)
+                await writer.drain()
+                if is_short(response):
+                    stream.closed = True  # the response framing is lost
                     break
-            server.close_connection()
+    except ConnectionResetError:
+        pass  # the client went away
+    finally:
+        stream.abort()
+        writer.close()
+        await writer.wait_closed()
+
+
+def connection_options():
+    """ReliableUDP options from the command line.
+
+    --rate-limit caps each connection at that many bytes per second, so one
+    bulk download cannot take the whole link from the other clients.
+    """
+    if '--rate-limit' in sys.argv:
+        return {'rate_limit': float(sys.argv[sys.argv.index('--rate-limit') + 1])}
+    return {}
+
+
+def main():
+    ip = '127.0.0.1'
+    port = 8080
+    listener = Listener(ip, port, **connection_options())
+    listener.set_debug_mode(True)
+    print(f"Server is running...on IP Address = {ip} and port Number = {port}")
+
+    # Every client gets its own thread; the listener routes its packets to it
+    while True:
+        connection = listener.accept()
+        if connection:
+            print(f"Connection accepted from {connection.remote_addr}.")
+            threading.Thread(target=handle_client, args=(connection,), daemon=True).start()
+
+
+def main_prefork(workers):
+    """Serve from worker processes sharing the port; SIGHUP restarts them gracefully."""
+    ip = '127.0.0.1'
+    port = 8080
+    server = PreforkServer(handle_client, ip, port, workers=workers, **connection_options())
+    print(f"Server is running ({server.workers} workers)...on IP Address = {ip} and port Number = {port}")
+    server.serve_forever()
+
+
+async def main_async():
+    """Serve every client from one event loop instead of a thread per client."""
+    ip = '127.0.0.1'
+    port = 8080
+    await start_server(handle_client_async, ip, port, **connection_options())
+    print(f"Server is running (asyncio)...on IP Address = {ip} and port Number = {port}")
+    await asyncio.Event().wait()
 
 if __name__ == '__main__':
-    main()
+    if '--async' in sys.argv:
+        asyncio.run(main_async())
+    elif '--workers' in sys.argv:
+        main_prefork(int(sys.argv[sys.argv.index('--workers') + 1]))
+    else:
+        main()
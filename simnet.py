@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import random
+from collections import Counter, deque
+from reliable_udp import ReliableUDP
+
+
+class SimEndpoint(ReliableUDP):
+    """A ReliableUDP connection attached to a SimNetwork instead of a socket.
+
+    It reads the network's virtual clock and random source. The blocking
+    calls work unchanged from a single thread: while this endpoint waits
+    for a datagram, the network advances time and drives every other
+    endpoint in the background.
+    """
+
+    def __init__(self, network, local_ip, local_port, **options):
+        super().__init__(local_ip, local_port, sock=network, **options)
+        self.network = network
+        self.clock = network.clock
+        self.random = network.random
+        self._inbox = deque()  # (datagram, addr) delivered while this endpoint was waiting
+
+    def send_datagram(self, header, payload):
+        self.network.send(self.local_addr, self.remote_addr, header + payload)
+
+    def recv_datagram(self, timeout):
+        """Advance virtual time by up to timeout seconds until a datagram arrives."""
+        if not self._inbox:
+            self.network.run_until(lambda: self._inbox, timeout, waiting=self)
+        if self._inbox:
+            return self._inbox.popleft()
+        return None, None
+
+    def recv_ready(self):
+        datagrams = list(self._inbox)
+        self._inbox.clear()
+        return datagrams
+
+    def close(self):
+        """Detach from the network."""
+        self.network.detach(self)
+        self.debug_print("Endpoint detached")
+
+
+class SimNetwork:
+    """An in-process network with a virtual clock and seeded impairments.
+
+    Every datagram is independently lost with probability loss, corrupted
+    (one byte flipped) with probability corruption and duplicated with
+    probability duplicate. It then waits for the sender's link, if
+    bandwidth (bytes per second) is capped, and is dropped if more than
+    queue_limit bytes are already waiting there. Finally it travels for
+    delay seconds, plus or minus a uniform jitter, and with probability
+    reorder for another delay on top, so that later datagrams overtake it.
+
+    Time only moves when run_until() (or an endpoint's blocking call) waits,
+    and it jumps straight to the next delivery or timer, so thousands of
+    packets take milliseconds. Runs with the same seed are identical.
+    """
+
+    def __init__(self, seed=0, loss=0.0, corruption=0.0, duplicate=0.0, reorder=0.0, delay=0.001, jitter=0.0,
+                 bandwidth=None, queue_limit=None):
+        for name, rate in (("loss", loss), ("corruption", corruption), ("duplicate", duplicate),
+                           ("reorder", reorder)):
+            if not 0 <= rate <= 1:
+                raise ValueError(f"{name.capitalize()} rate must be between 0 and 1")
+        if delay < 0 or jitter < 0 or jitter > delay:
+            raise ValueError("Delay must be non-negative and at least the jitter")
+        if bandwidth is not None and bandwidth <= 0:
+            raise ValueError("Bandwidth must be positive")
+        self.loss = loss
+        self.corruption = corruption
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.delay = delay
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.queue_limit = queue_limit
+        self.random = random.Random(seed)
+        self.now = 0.0
+        self.endpoints = {}  # addr -> SimEndpoint
+        self.stats = Counter()  # sent, lost, corrupted, duplicated, queue_drops, delivered, unroutable
+        self._events = []  # heap of (arrival time, tie-breaker, src, dst, datagram)
+        self._order = itertools.count()
+        self._link_free_at = {}  # src -> when its link finishes sending what is queued
+
+    def clock(self):
+        return self.now
+
+    def endpoint(self, local_ip, local_port, **options):
+        """Create an endpoint at (local_ip, local_port); options are as for ReliableUDP."""
+        addr = (local_ip, local_port)
+        if addr in self.endpoints:
+            raise ValueError(f"Address {addr} already in use")
+        endpoint = SimEndpoint(self, local_ip, local_port, **options)
+        self.endpoints[addr] = endpoint
+        return endpoint
+
+    def detach(self, endpoint):
+        if self.endpoints.get(endpoint.local_addr) is endpoint:
+            del self.endpoints[endpoint.local_addr]
+
+    def send(self, src, dst, datagram):
+        self.stats["sent"] += 1
+        if self.random.random() < self.loss:
+            self.stats["lost"] += 1
+            return
+        if self.random.random() < self.corruption:
+            self.stats["corrupted"] += 1
+            corrupted = bytearray(datagram)
+            corrupted[self.random.randrange(len(corrupted))] ^= self.random.randint(1, 255)
+            datagram = bytes(corrupted)
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.stats["duplicated"] += 1
+            copies = 2
+
+        departs = self.now
+        if self.bandwidth:
+            free_at = max(self._link_free_at.get(src, self.now), self.now)
+            if self.queue_limit is not None and (free_at - self.now) * self.bandwidth + len(datagram) > self.queue_limit:
+                self.stats["queue_drops"] += 1
+                return
+            departs = free_at + len(datagram) / self.bandwidth
+            self._link_free_at[src] = departs
+
+        for _ in range(copies):
+            arrives = departs + self.delay + self.random.uniform(-self.jitter, self.jitter)
+            if self.random.random() < self.reorder:
+                arrives += self.delay
+            heapq.heappush(self._events, (arrives, next(self._order), src, dst, datagram))
+
+    def next_event(self, waiting):
+        """Virtual time of the next delivery or background timer, None if nothing is scheduled."""
+        times = [self._events[0][0]] if self._events else []
+        for endpoint in self.endpoints.values():
+            if endpoint is not waiting:
+                wait = endpoint.next_timeout()
+                if wait is not None:
+                    times.append(self.now + max(wait, 0))
+        return min(times, default=None)
+
+    def run_until(self, condition, timeout=None, waiting=None):
+        """Advance virtual time until condition() holds; False once timeout seconds pass.
+
+        Endpoints other than waiting (the one blocked in a call, if any) are
+        driven here: they handle their datagrams, fire their timers and send
+        what their windows allow. Datagrams for waiting go to its inbox.
+        Also returns False if nothing is left to happen.
+        """
+        deadline = None if timeout is None else self.now + max(timeout, 0)
+        while True:
+            for endpoint in list(self.endpoints.values()):
+                if endpoint is not waiting:
+                    endpoint.flush()
+            if condition():
+                return True
+            when = self.next_event(waiting)
+            if deadline is not None and (when is None or when > deadline):
+                self.now = deadline
+                return False
+            if when is None:
+                return False
+            self.now = max(self.now, when)
+            self.deliver_due(waiting)
+            for endpoint in list(self.endpoints.values()):
+                if endpoint is not waiting and endpoint.next_timeout() is not None and endpoint.next_timeout() <= 0:
+                    endpoint.start_batch()
+                    endpoint.check_timers()
+
+    def deliver_due(self, waiting):
+        while self._events and self._events[0][0] <= self.now:
+            _, _, src, dst, datagram = heapq.heappop(self._events)
+            endpoint = self.endpoints.get(dst)
+            if endpoint is None:
+                self.stats["unroutable"] += 1
+                continue
+            self.stats["delivered"] += 1
+            if endpoint is waiting:
+                endpoint._inbox.append((datagram, src))
+            else:
+                endpoint.start_batch()
+                endpoint.handle_datagram(datagram, src)
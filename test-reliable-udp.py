@@ -1,6 +1,17 @@
+import asyncio
+import os
+import tempfile
 import threading
 import time
 from reliable_udp import ReliableUDP
+from listener import Listener
+from async_reliable_udp import open_connection, start_server
+from simnet import SimNetwork
+from prefork import PreforkServer
+from timer_wheel import TimerWheel
+from http_parser import RequestParser, Request, HTTPParseError, NEED_DATA, END_OF_REQUEST
+from server import ResponseCache, RequestStream, response_cache, handle_client
+from client import ClientSession
 
 def test_normal_connection():
     print("\n--- Test: Normal Connection/Disconnection ---")
@@ -26,7 +37,7 @@ def test_normal_connection():
         print("[Client] Establishing connection...")
         if r_client.establish_connection():
             print("[Client] Connection established.")
-            if r_client.send("Test normal connection.", flags="DAT"):
+            if r_client.send("Test normal connection."):
                 print("[Client] Message sent successfully.")
             else:
                 print("[Client] Failed to send message.")
@@ -51,6 +62,7 @@ def test_various_message_sizes():
         "Short",
         "Medium message size test." * 10,
         "Large message: " + ("x" * 1000),
+        "Multi-segment message: " + ("y" * 20000),
     ]
 
     def server():
@@ -76,7 +88,7 @@ def test_various_message_sizes():
         if r_client.establish_connection():
             print("[Client] Connection established.")
             for msg in messages:
-                success = r_client.send(msg, flags="DAT")
+                success = r_client.send(msg)
                 print(f"[Client] Sent message of size {len(msg)}: {'Success' if success else 'Fail'}")
             r_client.close_connection()
         else:
@@ -118,7 +130,7 @@ def test_error_simulation(packet_loss_rate, corruption_rate):
         print("[Client] Establishing connection...")
         if r_client.establish_connection():
             print("[Client] Connection established.")
-            success = r_client.send("Testing error simulation", flags="DAT")
+            success = r_client.send("Testing error simulation")
             print(f"[Client] Message send status: {'Success' if success else 'Failed'}")
             r_client.close_connection()
         else:
@@ -201,7 +213,7 @@ def test_timeouts_and_retransmissions():
         print("[Client] Establishing connection...")
         if r_client.establish_connection():
             print("[Client] Connection established.")
-            success = r_client.send("Testing retransmission under high packet loss", flags="DAT")
+            success = r_client.send("Testing retransmission under high packet loss")
             print(f"[Client] Message send status: {'Success' if success else 'Failed'}")
             r_client.close_connection()
         else:
@@ -217,11 +229,561 @@ def test_timeouts_and_retransmissions():
     print("Timeouts and retransmission test done.\n")
 
 
+def test_transmission_modes():
+    print("\n--- Test: Stop-and-Wait, Go-Back-N and Selective Repeat ---")
+
+    message = b"Windowed transfer: " + (b"z" * 50000)
+
+    def run(mode, seed):
+        net = SimNetwork(seed=seed, loss=0.05, delay=0.01)
+        r_client = net.endpoint("10.0.0.1", 16006, mode=mode)
+        r_server = net.endpoint("10.0.0.2", 15006, mode=mode)
+        r_server.start_listen()
+        if not r_client.establish_connection("10.0.0.2", 15006):
+            return None, net.now, {}
+        success = r_client.send(message)
+        received = r_server.receive()
+        r_client.close_connection()
+        return success and received, net.now, r_client.stats()
+
+    for mode in ["stop-and-wait", "gbn", "sr"]:
+        received, elapsed, stats = run(mode, seed=6)
+        print(f"[Sim] ({mode}) Received {len(received) if received else 0} bytes in {elapsed:.2f}s of virtual time, "
+              f"{stats.get('retransmissions')} retransmissions")
+        assert received == message, f"{mode} did not deliver the message intact"
+        assert run(mode, seed=6) == (received, elapsed, stats), f"{mode} run was not reproducible"
+    print("Transmission modes test done.\n")
+
+
+def test_congestion_control():
+    print("\n--- Test: Reno, CUBIC and BBR congestion control ---")
+
+    message = b"Congestion controlled transfer: " + (b"c" * 100000)
+
+    def run(congestion, seed):
+        net = SimNetwork(seed=seed, loss=0.05, delay=0.01, bandwidth=1e6, queue_limit=64000)
+        r_client = net.endpoint("10.0.0.1", 16009, window_size=64, congestion=congestion)
+        r_server = net.endpoint("10.0.0.2", 15009, window_size=64, congestion=congestion)
+        r_server.start_listen()
+        if not r_client.establish_connection("10.0.0.2", 15009):
+            return None, net.now, {}
+        success = r_client.send(message)
+        received = r_server.receive()
+        stats = r_client.stats()  # the windows as the transfer left them
+        r_client.close_connection()
+        return success and received, net.now, stats
+
+    for congestion in ["reno", "cubic", "bbr"]:
+        received, elapsed, stats = run(congestion, seed=9)
+        print(f"[Sim] ({congestion}) Received {len(received) if received else 0} bytes in {elapsed:.2f}s "
+              f"of virtual time, cwnd={stats.get('cwnd', 0):.1f}, ssthresh={stats.get('ssthresh', 0):.1f}")
+        assert received == message, f"{congestion} did not deliver the message intact"
+        assert run(congestion, seed=9) == (received, elapsed, stats), f"{congestion} run was not reproducible"
+    print("Congestion control test done.\n")
+
+
+def test_flow_control():
+    print("\n--- Test: Flow Control with a Slow Receiver ---")
+
+    messages = [f"Message {i}: ".encode() + bytes([65 + i]) * 20000 for i in range(5)]
+    net = SimNetwork(seed=12, delay=0.01)
+    r_client = net.endpoint("10.0.0.1", 16012, mss=1000)
+    # Room for only four segments: the sender must wait for every read
+    r_server = net.endpoint("10.0.0.2", 15012, mss=1000, receive_buffer=4000)
+    r_server.start_listen()
+
+    assert r_client.establish_connection("10.0.0.2", 15012), "Connection failed"
+    for msg in messages:
+        r_client.queue_data(msg)
+    received = []
+    buffered = []
+    while len(received) < len(messages):
+        msg = r_server.receive()
+        if not msg:
+            break
+        received.append(msg)
+        net.run_until(lambda: False, 0.2)  # slow consumer; the client runs meanwhile
+        buffered.append(r_server.stats()["buffered"])
+    r_client.close_connection()
+    print(f"[Sim] Received {len(received)} messages in {net.now:.2f}s of virtual time, "
+          f"at most {max(buffered, default=0)} bytes waiting to be read")
+    assert received == messages, "Messages were not delivered intact and in order"
+    # A message may outgrow the buffer while it is reassembled, but once it is
+    # complete and unread the window closes and the sender must wait
+    assert max(buffered) <= max(map(len, messages)) + 4000, "The sender ran ahead of the slow receiver"
+    print("Flow control test done.\n")
+
+
+def test_multiple_clients():
+    print("\n--- Test: Many Clients on One Listener ---")
+
+    num_clients = 20
+    listener = Listener(local_ip="127.0.0.1", local_port=15013)
+    results = []
+
+    def handle(connection):
+        msg = connection.receive()
+        if msg:
+            connection.send(b"echo: " + msg)
+        connection.receive()  # wait for the client's FIN
+        connection.close_connection()
+        connection.close()
+
+    def server():
+        for _ in range(num_clients):
+            connection = listener.accept(timeout=10)
+            if not connection:
+                print("[Server] Accept timed out.")
+                return
+            threading.Thread(target=handle, args=(connection,)).start()
+
+    def client(i):
+        # The listener is already bound, so clients can connect straight away
+        r_client = ReliableUDP(local_ip="127.0.0.1", local_port=16013 + i,
+                               remote_ip="127.0.0.1", remote_port=15013)
+        if r_client.establish_connection():
+            r_client.send(f"client {i}")
+            results.append(r_client.receive() == f"echo: client {i}".encode())
+            r_client.close_connection()
+        r_client.close()
+
+    threads = [threading.Thread(target=server)] + [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    listener.close()
+    print(f"[Client] {sum(results)}/{num_clients} clients got their own echo")
+    assert sum(results) == num_clients, "Not every client got its own echo"
+    print("Multiple clients test done.\n")
+
+
+def test_asyncio_connections():
+    print("\n--- Test: asyncio Streams, Many Connections on One Thread ---")
+
+    num_clients = 200
+
+    async def handle(reader, writer):
+        line = await reader.readline()
+        writer.write(b"echo: " + line)
+        await writer.drain()
+        await reader.read()  # wait for the client's FIN
+        writer.close()
+        await writer.wait_closed()
+
+    async def client(i):
+        reader, writer = await open_connection("127.0.0.1", 15014)
+        writer.write(f"client {i}\n".encode())
+        reply = await reader.readline()
+        writer.close()
+        await writer.wait_closed()
+        return reply == f"echo: client {i}\n".encode()
+
+    async def main():
+        server = await start_server(handle, "127.0.0.1", 15014)
+        start = time.time()
+        try:
+            results = await asyncio.gather(*(client(i) for i in range(num_clients)))
+        finally:
+            server.close()
+        print(f"[Client] {results.count(True)}/{num_clients} clients got their own echo in {time.time() - start:.2f}s")
+        assert results.count(True) == num_clients, "Not every client got its own echo"
+
+    asyncio.run(main())
+    print("asyncio connections test done.\n")
+
+
+def test_simulated_network():
+    print("\n--- Test: Simulated Network (Virtual Clock, Seeded Impairments) ---")
+
+    messages = [bytes([65 + i]) * 100000 for i in range(5)]
+
+    def run(seed):
+        net = SimNetwork(seed=seed, loss=0.1, corruption=0.02, duplicate=0.02, reorder=0.05,
+                         delay=0.02, jitter=0.005, bandwidth=1e6, queue_limit=64000)
+        r_client = net.endpoint("10.0.0.1", 16015, window_size=64)
+        r_server = net.endpoint("10.0.0.2", 15015, window_size=64)
+        r_server.start_listen()  # driven by the network while the client's calls wait
+        transitions = []
+
+        def on_event(connection, event, details):
+            if event == "state":
+                transitions.append(details["new"])
+
+        r_client.on_event = on_event
+        received = []
+        if r_client.establish_connection("10.0.0.2", 15015):
+            for msg in messages:
+                r_client.send(msg)
+                received.append(r_server.receive())
+            r_client.close_connection()
+        return received == messages, net.now, dict(net.stats), r_client.stats(), transitions
+
+    start = time.time()
+    first = run(seed=1)
+    second = run(seed=1)
+    print(f"[Sim] Delivered in order: {first[0]}, {first[1]:.2f}s of virtual time in {time.time() - start:.2f}s "
+          f"for both runs, stats={first[2]}")
+    stats = first[3]
+    print(f"[Sim] Client: {stats['packets_sent']} packets sent, {stats['retransmissions']} retransmissions, "
+          f"{stats['timeouts']} timeouts, {stats['rtt_samples']} RTT samples, states {' -> '.join(first[4])}")
+    print(f"[Sim] Same seed reproduced the run: {first == second}")
+    assert first[0], "Messages were not delivered intact and in order"
+    assert first == second, "The same seed did not reproduce the run"
+    print("Simulated network test done.\n")
+
+
+def test_streamed_message():
+    print("\n--- Test: Streaming a Large Message from a Generator ---")
+
+    net = SimNetwork(seed=2, loss=0.05, delay=0.01)
+    r_client = net.endpoint("10.0.0.1", 16016, window_size=64)
+    r_server = net.endpoint("10.0.0.2", 15016, window_size=64)
+    r_server.start_listen()
+    chunks = [bytes([i % 251]) * 7777 for i in range(500)]  # about 3.9 MB, not a multiple of the MSS
+    held = []
+
+    def produce():
+        for chunk in chunks:
+            held.append(len(r_client._unacked))
+            yield chunk
+
+    if r_client.establish_connection("10.0.0.2", 15016):
+        r_client.send(produce())
+        received = r_server.receive()
+        print(f"[Sim] Received {len(received)} bytes intact: {received == b''.join(chunks)}")
+        print(f"[Sim] At most {max(held)} segments were held in the send buffer while streaming")
+        assert received == b''.join(chunks), "The streamed message was not delivered intact"
+        r_client.close_connection()
+    else:
+        raise AssertionError("Connection failed")
+    print("Streamed message test done.\n")
+
+
+def test_stream_multiplexing():
+    print("\n--- Test: Independent Streams on One Connection ---")
+
+    net = SimNetwork(seed=4, loss=0.05, delay=0.01)
+    r_client = net.endpoint("10.0.0.1", 16018, window_size=64)
+    r_server = net.endpoint("10.0.0.2", 15018, window_size=64)
+    r_server.start_listen()
+    download = bytes(range(256)) * 4000  # about 1 MB
+    page = b"<html><body>A small page</body></html>"
+
+    if r_client.establish_connection("10.0.0.2", 15018):
+        # The page is queued behind the download, but on its own stream
+        r_client.queue_data(download)
+        stream = r_client.open_stream()
+        stream.queue_data(page)
+        r_client.flush()
+        incoming = r_server.accept_stream()
+        received_page = incoming.receive() if incoming else None
+        page_time = net.now
+        download_done = bool(r_server.readable())
+        received_download = r_server.receive()
+        print(f"[Sim] Page on stream {incoming.id if incoming else None} intact: {received_page == page}, "
+              f"after {page_time:.2f}s, download already complete then: {download_done}")
+        print(f"[Sim] Download intact: {received_download == download}, after {net.now:.2f}s "
+              f"({r_client.stats()['retransmissions']} retransmissions)")
+        assert received_page == page, "The page was not delivered intact on its own stream"
+        assert not download_done, "The page waited behind the download"
+        assert received_download == download, "The download was not delivered intact"
+        stream.send(b"ping")
+        reply = incoming.receive()
+        print(f"[Sim] Reply on the same stream: {reply == b'ping'}")
+        assert reply == b"ping", "The reply did not arrive on the same stream"
+        r_client.close_connection()
+    else:
+        raise AssertionError("Connection failed")
+    print("Stream multiplexing test done.\n")
+
+
+def test_pacing():
+    print("\n--- Test: Pacing and Per-Connection Rate Limits ---")
+
+    messages = [bytes([i]) * 100000 for i in range(10)]
+
+    def run(**options):
+        # A 1 MB/s link whose queue holds about a dozen segments
+        net = SimNetwork(seed=5, delay=0.01, bandwidth=1e6, queue_limit=16000)
+        r_client = net.endpoint("10.0.0.1", 16019, window_size=64, **options)
+        r_server = net.endpoint("10.0.0.2", 15019, window_size=64)
+        r_server.start_listen()
+        if not r_client.establish_connection("10.0.0.2", 15019):
+            return False, 0.0, 0, 0
+        start = net.now
+        ok = all(r_client.send(msg) and r_server.receive() == msg for msg in messages)
+        elapsed = net.now - start
+        r_client.close_connection()
+        return ok, elapsed, net.stats["queue_drops"], r_client.stats()["retransmissions"]
+
+    results = {}
+    for label, options in (("bursts", dict(pacing=False)), ("paced", {}), ("capped at 200 KB/s", dict(rate_limit=2e5))):
+        ok, elapsed, drops, retransmissions = results[label] = run(**options)
+        print(f"[Sim] {label:18} delivered: {ok}, {elapsed:.2f}s, {drops} datagrams dropped at the link queue, "
+              f"{retransmissions} retransmissions")
+        assert ok, f"{label}: messages were not delivered intact"
+        assert run(**options) == (ok, elapsed, drops, retransmissions), f"{label}: run was not reproducible"
+    assert results["paced"][2] < results["bursts"][2], "Pacing did not reduce the drops at the link queue"
+    assert results["capped at 200 KB/s"][1] >= sum(map(len, messages)) / 2e5, "The rate limit was exceeded"
+
+    # Timeouts under heavy loss must not collapse BBR's pacing rate until the receiver gives up
+    net = SimNetwork(seed=3, loss=0.1, corruption=0.05, duplicate=0.05, reorder=0.2, delay=0.01, jitter=0.005,
+                     bandwidth=2e6, queue_limit=30000)
+    r_client = net.endpoint("10.0.0.1", 16020, mode="gbn", window_size=16, mss=500, congestion="bbr")
+    r_server = net.endpoint("10.0.0.2", 15020, mode="gbn", window_size=16, mss=500, congestion="bbr")
+    r_server.start_listen()
+    message = bytes(range(250)) * 80
+    assert r_client.establish_connection("10.0.0.2", 15020), "Connection failed"
+    r_client.queue_data(message)
+    received = r_server.receive()
+    print(f"[Sim] Paced BBR over a lossy link delivered: {received == message}, after {net.now:.2f}s "
+          f"({r_client.stats()['timeouts']} timeouts)")
+    assert received == message, "Paced BBR stalled after retransmission timeouts"
+    print("Pacing test done.\n")
+
+
+def test_prefork_workers():
+    print("\n--- Test: Worker Processes Sharing a Port (SO_REUSEPORT) ---")
+
+    def echo_pid(connection):
+        while connection.connected:
+            message = connection.receive()
+            if not message:
+                break
+            connection.send(str(os.getpid()).encode())
+        connection.close_connection()
+        connection.close()
+
+    workers = PreforkServer(echo_pid, "127.0.0.1", 15017, workers=3)
+    workers.start()
+    print(f"[Server] 3 workers, steering by {'connection id' if workers.steered else 'address hash'}")
+    results = []
+
+    def client(i):
+        r_client = ReliableUDP("127.0.0.1", 16100 + i, "127.0.0.1", 15017)
+        pids = set()
+        if r_client.establish_connection():
+            for _ in range(3):
+                r_client.send(b"ping")
+                pids.add(r_client.receive())
+            r_client.close_connection()
+        r_client.close()
+        results.append(pids)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(9)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    workers.stop()
+    sticky = all(len(pids) == 1 and None not in pids for pids in results)
+    print(f"[Client] Every connection stayed on one worker: {sticky}; "
+          f"{len(set().union(*results))} workers served the 9 clients")
+    assert sticky, "A connection's packets reached more than one worker"
+    print("Prefork workers test done.\n")
+
+
+def test_timer_wheel():
+    print("\n--- Test: Hierarchical Timer Wheel ---")
+
+    # Deadlines on both sides of each level's boundary, and beyond the wheel's span
+    deadlines = [1, 63, 64, 65, 200, 4095, 4096, 4097, 300000, 1 << 24, (1 << 24) + 5000, 1 << 26]
+    wheel = TimerWheel(now=0, tick=1)  # one-second ticks keep the arithmetic exact
+    fired = []
+    timers = {deadline: wheel.schedule(deadline, lambda deadline=deadline: fired.append((deadline, wheel.current)))
+              for deadline in deadlines}
+    for deadline in (65, 4096):
+        timers.pop(deadline).cancel()
+    wakeups = 0
+    while wheel.next_expiry() is not None:
+        wakeups += 1
+        wheel.advance(wheel.next_expiry())
+        if wheel.current == 200:
+            # Cancel one timer after it has cascaded down, and arm a new one mid-run
+            timers.pop(4097).cancel()
+            timers[5000] = wheel.schedule(5000, lambda: fired.append((5000, wheel.current)))
+    expected = sorted(timers)
+    print(f"[Wheel] {len(fired)} timers fired after {wakeups} wakeups, at ticks {[tick for _, tick in fired]}")
+    assert fired == [(deadline, deadline) for deadline in expected], "A timer fired at the wrong tick"
+    assert wakeups == len(expected), "The wheel woke up with nothing due"
+    assert len(wheel) == 0
+
+    # One long jump fires everything, in deadline order, each at its own tick
+    wheel = TimerWheel(now=0, tick=1)
+    fired = []
+    for deadline in reversed(deadlines):
+        wheel.schedule(deadline, lambda deadline=deadline: fired.append((deadline, wheel.current)))
+    assert wheel.advance(1 << 27) == len(deadlines)
+    assert fired == [(deadline, deadline) for deadline in deadlines], "A long jump fired timers out of order"
+    print("Timer wheel test done.\n")
+
+
+def test_request_parser():
+    print("\n--- Test: Incremental HTTP Request Parser ---")
+
+    def parse(data, step=1, **limits):
+        """Feed data step bytes at a time; the events, or the error status."""
+        parser = RequestParser(**limits)
+        events = []
+        try:
+            for i in range(0, len(data), step):
+                parser.feed(data[i:i + step])
+                event = parser.next_event()
+                while event != NEED_DATA:
+                    events.append(event)
+                    event = parser.next_event()
+        except HTTPParseError as e:
+            return e.status
+        return events
+
+    post = b"POST /form HTTP/1.1\r\nHost: x\r\nContent-Length: 11\r\n\r\nhello world"
+    events = parse(post)
+    body = b"".join(event for event in events if isinstance(event, bytes))
+    print(f"[Parser] Byte by byte: {events[0]}, body {body!r}")
+    assert isinstance(events[0], Request) and events[0].headers["content-length"] == "11"
+    assert body == b"hello world" and events[-1] == END_OF_REQUEST
+
+    pipelined = b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n" + post
+    events = parse(pipelined, step=len(pipelined))
+    requests = [event.path for event in events if isinstance(event, Request)]
+    print(f"[Parser] Pipelined in one buffer: {requests}")
+    assert requests == ["/a", "/form"] and events.count(END_OF_REQUEST) == 2
+
+    errors = {
+        "request line too long": (parse(b"GET /" + b"a" * 200, max_header_bytes=100), 431),
+        "headers too large": (parse(b"GET / HTTP/1.1\r\n" + b"X: y\r\n" * 30 + b"\r\n", max_header_bytes=100), 431),
+        "too many header fields": (parse(b"GET / HTTP/1.1\r\n" + b"X: y\r\n" * 5 + b"\r\n", max_headers=4), 431),
+        "negative Content-Length": (parse(b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n"), 400),
+        "superscript Content-Length": (parse("POST / HTTP/1.1\r\nContent-Length: \u00b2\r\n\r\n".encode("latin-1")), 400),
+        "malformed request line": (parse(b"GET /\r\n\r\n"), 400),
+        "Transfer-Encoding": (parse(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"), 501),
+    }
+    for name, (status, expected) in errors.items():
+        print(f"[Parser] {name}: {status}")
+        assert status == expected, f"{name}: expected {expected}, got {status}"
+    print("Request parser test done.\n")
+
+
+def test_response_cache():
+    print("\n--- Test: GET Response Cache ---")
+
+    with tempfile.TemporaryDirectory(dir=".") as directory:
+        paths = {}
+        for name in "abc":
+            paths[name] = os.path.join(directory, f"{name}.html")
+            with open(paths[name], "wb") as f:
+                f.write(name.encode() * 100)
+        # Room for two 100-byte files; stat() on every lookup
+        cache = ResponseCache(max_bytes=250, max_file=200, check_interval=0)
+
+        first = cache.get(paths["a"])
+        hit = cache.get(paths["a"])
+        print(f"[Cache] Second lookup: hits={cache.hits}, misses={cache.misses}")
+        assert hit is first and (cache.hits, cache.misses) == (1, 1)
+
+        with open(paths["a"], "wb") as f:
+            f.write(b"A" * 100)
+        os.utime(paths["a"], ns=(first.mtime_ns + 10 ** 9, first.mtime_ns + 10 ** 9))
+        changed = cache.get(paths["a"])
+        print(f"[Cache] After the file changed: reloaded {changed.body[:1]!r}, new ETag {changed.etag != first.etag}")
+        assert changed.body == b"A" * 100 and changed.etag != first.etag and cache.misses == 2
+
+        cache.get(paths["b"])
+        cache.get(paths["a"])  # a is now the most recently used
+        cache.get(paths["c"])
+        misses = cache.misses
+        cache.get(paths["a"])
+        cache.get(paths["b"])
+        print(f"[Cache] {cache.total_bytes} of {cache.max_bytes} bytes held; b evicted: {cache.misses == misses + 1}")
+        assert cache.total_bytes <= cache.max_bytes and cache.misses == misses + 1, "The wrong file was evicted"
+
+        # A matching If-None-Match is answered with 304, through the server's own cache
+        request = f"GET /{os.path.relpath(paths['c'])} HTTP/1.1\r\nHost: x\r\n".encode()
+        response = RequestStream().feed(request + b"\r\n")[0]
+        etag = response_cache.get(os.path.relpath(paths["c"])).etag
+        revalidated = RequestStream().feed(request + f"If-None-Match: {etag}\r\n\r\n".encode())[0]
+        stale = RequestStream().feed(request + b'If-None-Match: "other"\r\n\r\n')[0]
+        status_lines = [r.partition(b"\r\n")[0].decode() for r in (response, revalidated)]
+        print(f"[Cache] {status_lines[0]}, then {status_lines[1]} with its ETag")
+        assert response.startswith(b"HTTP/1.1 200") and f"ETag: {etag}".encode() in response
+        assert revalidated.startswith(b"HTTP/1.1 304") and not revalidated.endswith(b"c" * 100)
+        assert stale.startswith(b"HTTP/1.1 200")
+    print("Response cache test done.\n")
+
+
+def test_client_session():
+    print("\n--- Test: Pooled Client Connections ---")
+
+    listener = Listener(local_ip="127.0.0.1", local_port=15021)
+    accepted = []
+    serving = threading.Event()
+    serving.set()
+
+    def server():
+        while serving.is_set():
+            connection = listener.accept(timeout=0.2)
+            if connection:
+                accepted.append(connection)
+                threading.Thread(target=handle_client, args=(connection,)).start()
+
+    threading.Thread(target=server).start()
+    addr = ("127.0.0.1", 15021)
+    session = ClientSession(addr, max_per_host=2, idle_timeout=0.5)
+    try:
+        responses = [session.request("GET", "/index.html") for _ in range(3)]
+        print(f"[Client] 3 requests in a row used {len(accepted)} connection(s), "
+              f"{session._open[addr]} open, {len(session._idle[addr])} idle")
+        assert all(response and response.startswith(b"HTTP/1.1 200") for response in responses)
+        assert len(accepted) == 1 and session._open[addr] == 1 and len(session._idle[addr]) == 1
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(session.request("GET", "/index.html")))
+                   for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print(f"[Client] 6 concurrent requests: {len(results)} answered, {len(accepted)} connections in all, "
+              f"{session._open[addr]} open")
+        assert len(results) == 6 and all(response and response.startswith(b"HTTP/1.1 200") for response in results)
+        assert len(accepted) <= 2 and session._open[addr] <= 2, "max_per_host was exceeded"
+
+        pooled = [http for http, _ in session._idle[addr]]
+        time.sleep(0.6)  # past idle_timeout
+        response = session.request("GET", "/index.html")
+        print(f"[Client] After idle_timeout: {len(accepted)} connections in all, {session._open[addr]} open, "
+              f"expired ones closed: {not any(http.connection.connected for http in pooled)}")
+        assert response and response.startswith(b"HTTP/1.1 200")
+        assert not any(http.connection.connected for http in pooled), "Expired connections were not closed"
+        assert session._open[addr] == 1 and len(accepted) == len(pooled) + 1
+    finally:
+        session.close()
+        serving.clear()
+        time.sleep(0.3)
+        listener.close()
+    print("Client session test done.\n")
+
+
 if __name__ == "__main__":
     test_normal_connection()
     test_various_message_sizes()
     test_error_simulation(packet_loss_rate=0.1, corruption_rate=0.05)
     test_simultaneous_close()
     test_timeouts_and_retransmissions()
+    test_transmission_modes()
+    test_congestion_control()
+    test_flow_control()
+    test_multiple_clients()
+    test_asyncio_connections()
+    test_simulated_network()
+    test_streamed_message()
+    test_stream_multiplexing()
+    test_pacing()
+    test_prefork_workers()
+    test_timer_wheel()
+    test_request_parser()
+    test_response_cache()
+    test_client_session()
     
     print("All tests completed.")
@@ -0,0 +1,153 @@
+import math
+
+# Resolution of the wheel in seconds; deadlines are rounded up to a whole tick
+TICK = 0.001
+
+# Each level has 2**LEVEL_BITS slots, and LEVELS levels cover
+# 2**(LEVEL_BITS * LEVELS) ticks (about 4.7 hours at the default tick).
+# Later deadlines are parked in the last level and re-placed as it turns.
+LEVEL_BITS = 6
+LEVELS = 4
+SLOTS = 1 << LEVEL_BITS
+MASK = SLOTS - 1
+
+
+class Timer:
+    """A callback armed on a TimerWheel; cancel() disarms it."""
+
+    __slots__ = ("wheel", "expires", "callback", "slot", "level")
+
+    def __init__(self, wheel, expires, callback):
+        self.wheel = wheel
+        self.expires = expires  # in ticks
+        self.callback = callback
+        self.slot = None  # the dict holding it while armed
+        self.level = 0
+
+    @property
+    def deadline(self):
+        return self.expires * self.wheel.tick
+
+    def cancel(self):
+        if self.slot is not None:
+            del self.slot[self]
+            self.wheel._counts[self.level] -= 1
+            self.slot = None
+
+
+class TimerWheel:
+    """Hierarchical timing wheel: O(1) arming and cancelling of any number of timers.
+
+    Level 0 has one slot per tick for the next SLOTS ticks; each higher level
+    has slots SLOTS times as wide. A timer goes into the finest level whose
+    span reaches its deadline. Whenever the lower levels complete a turn,
+    the current slot of the next level is emptied and its timers placed
+    again, closer to their deadline (a cascade). Each timer is thus moved
+    at most LEVELS times, however many there are.
+
+    An I/O loop calls advance() with the current time, whenever
+    next_expiry() says something may be due; advance() fires the due
+    callbacks. Times are in seconds on whatever clock the caller uses.
+    """
+
+    def __init__(self, now=0.0, tick=TICK):
+        if tick <= 0:
+            raise ValueError("Tick must be positive")
+        self.tick = tick
+        self.current = int(now / tick)  # the last tick processed
+        self._levels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self._counts = [0] * LEVELS  # armed timers per level
+
+    def __len__(self):
+        return sum(self._counts)
+
+    def schedule(self, deadline, callback):
+        """Arm callback() to run at deadline (seconds); a past deadline counts as the next tick."""
+        timer = Timer(self, max(math.ceil(deadline / self.tick), self.current + 1), callback)
+        self.place(timer)
+        return timer
+
+    def place(self, timer):
+        # A cascade may bring down a timer due at the current tick, whose slot is processed next
+        expires = max(timer.expires, self.current)
+        delta = expires - self.current
+        level = 0
+        while level < LEVELS - 1 and delta >= 1 << (LEVEL_BITS * (level + 1)):
+            level += 1
+        if delta >= 1 << (LEVEL_BITS * LEVELS):
+            # Beyond the wheel: park in the farthest slot and place again from there
+            expires = self.current + (1 << (LEVEL_BITS * LEVELS)) - 1
+        slot = self._levels[level][(expires >> (LEVEL_BITS * level)) & MASK]
+        slot[timer] = None
+        timer.slot = slot
+        timer.level = level
+        self._counts[level] += 1
+
+    def advance(self, now):
+        """Fire every timer due by now, in deadline order; returns how many fired."""
+        target = int(now / self.tick)
+        fired = 0
+        while self.current < target:
+            level = next((level for level, count in enumerate(self._counts) if count), None)
+            if level is None:
+                self.current = target
+                break
+            # Nothing happens before the lowest occupied level's next cascade, so jump there
+            span = 1 << (LEVEL_BITS * level)
+            self.current = min(target, (self.current | (span - 1)) + 1)
+            if self.current & MASK == 0:
+                self.cascade()
+            slot = self._levels[0][self.current & MASK]
+            if not slot:
+                continue
+            timers = list(slot)
+            slot.clear()
+            self._counts[0] -= len(timers)
+            due = []
+            for timer in timers:
+                timer.slot = None
+                if timer.expires > self.current:
+                    self.place(timer)  # parked beyond the wheel's span
+                else:
+                    due.append(timer)
+            for timer in due:
+                fired += 1
+                timer.callback()
+        return fired
+
+    def cascade(self):
+        """Place again the timers of each higher level whose slot the wheel has turned to."""
+        for level in range(1, LEVELS):
+            index = (self.current >> (LEVEL_BITS * level)) & MASK
+            slot = self._levels[level][index]
+            timers = list(slot)
+            slot.clear()
+            self._counts[level] -= len(timers)
+            for timer in timers:
+                self.place(timer)
+            if index:
+                break
+
+    def next_expiry(self):
+        """The earliest deadline of any armed timer (seconds), None if none is armed.
+
+        No timer in a slot is due before the slot's first tick, so each level
+        is scanned from the current slot until that passes the earliest found.
+        A coarser level may still hold an earlier timer than a finer one, and
+        a timer parked beyond the wheel sits in a slot earlier than its own.
+        """
+        expiry = None
+        for level, count in enumerate(self._counts):
+            if not count:
+                continue
+            shift = LEVEL_BITS * level
+            slots = self._levels[level]
+            base = self.current >> shift
+            for offset in range(1, SLOTS + 1):
+                if expiry is not None and (base + offset) << shift >= expiry:
+                    break
+                slot = slots[(base + offset) & MASK]
+                if slot:
+                    earliest = min(timer.expires for timer in slot)
+                    expiry = earliest if expiry is None else min(expiry, earliest)
+        return None if expiry is None else expiry * self.tick